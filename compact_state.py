@@ -0,0 +1,227 @@
+import numpy as np
+from typing import Iterable, Iterator, Mapping, Optional, Union
+
+IdsLike = Union[np.ndarray, Iterable[int]]
+
+
+def as_ids(values: IdsLike) -> np.ndarray:
+    if isinstance(values, np.ndarray):
+        return values.astype(np.int64, copy=False)
+
+    return np.fromiter(values, dtype=np.int64)
+
+
+# telegram id из username, если username - его каноническая запись ("42", не "042")
+def numeric_username(username: str) -> Optional[int]:
+    try:
+        value = int(username)
+    except ValueError:
+        return None
+
+    return value if str(value) == username else None
+
+
+class IdSet:
+    """
+    Множество int64 id как отсортированный массив без повторов: 8 байт на id
+    против ~70 у set[int]. Проверка одного id - бинарный поиск, массовые
+    операции (contains, update) - векторные.
+    """
+
+    __slots__ = ("ids",)
+
+    def __init__(self, values: IdsLike = ()):
+        self.ids = np.unique(as_ids(values))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids.tolist())
+
+    def __contains__(self, value: int) -> bool:
+        position = np.searchsorted(self.ids, value)
+        return position < len(self.ids) and self.ids[position] == value
+
+    # маска: True для values, которые есть в множестве
+    def contains(self, values: IdsLike) -> np.ndarray:
+        values = as_ids(values)
+
+        if not len(self.ids):
+            return np.zeros(len(values), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(self.ids, values), len(self.ids) - 1)
+        return self.ids[positions] == values
+
+    # Слияние без пересортировки всего массива: O(n) копирование на вставку
+    def update(self, values: IdsLike) -> None:
+        values = np.unique(as_ids(values))
+        values = values[~self.contains(values)]
+
+        if len(values):
+            self.ids = np.insert(self.ids, np.searchsorted(self.ids, values), values)
+
+
+class ProgressTable:
+    """
+    Прогресс трафика по username: отсортированные telegram id, параллельно
+    user_id (int64) и байт флагов KPASSED_* (uint8) - 17 байт на пользователя.
+    Нечисловые username (их единицы) лежат в dict рядом.
+    """
+
+    def __init__(self, rows: Iterable[tuple[str, int, int]] = ()):
+        keys: list[int] = []
+        user_ids: list[int] = []
+        flags: list[int] = []
+        self.__other: dict[str, tuple[int, int]] = {}
+
+        for username, user_id, user_flags in rows:
+            key = numeric_username(username)
+
+            if key is None:
+                self.__other[username] = (user_id, user_flags)
+                continue
+
+            keys.append(key)
+            user_ids.append(user_id)
+            flags.append(user_flags)
+
+        order = np.argsort(np.array(keys, dtype=np.int64), kind="stable")
+        self.keys = np.array(keys, dtype=np.int64)[order]
+        self.user_ids = np.array(user_ids, dtype=np.int64)[order]
+        self.flags = np.array(flags, dtype=np.uint8)[order]
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.__other)
+
+    # (user_id, flags) или None, если у пользователя нет строки прогресса
+    def get(self, username: str) -> Optional[tuple[int, int]]:
+        key = numeric_username(username)
+
+        if key is None:
+            return self.__other.get(username)
+
+        position = np.searchsorted(self.keys, key)
+
+        if position == len(self.keys) or self.keys[position] != key:
+            return None
+
+        return int(self.user_ids[position]), int(self.flags[position])
+
+
+KNO_USER_ID = -1
+
+
+# uuid как ascii bytes (S36); уже закодированный массив возвращается как есть
+def encode_uuids(uuids) -> np.ndarray:
+    if isinstance(uuids, np.ndarray) and uuids.dtype.kind == "S":
+        return uuids
+
+    return np.char.encode(np.asarray(uuids, dtype=str), "ascii")
+
+
+def decode_uuids(uuids: np.ndarray) -> list[str]:
+    if uuids.dtype.kind == "S":
+        return np.char.decode(uuids, "ascii").tolist()
+
+    return uuids.tolist()
+
+
+class TrafficSnapshotTable:
+    """
+    Снапшот трафика по uuid между циклами: отсортированные uuid (ascii bytes),
+    параллельно трафик (float64), user_id (int64, KNO_USER_ID - нет строки
+    прогресса) и байт флагов KPASSED_* - ~53 байта на пользователя вместо
+    ~300 у dict[str, NamedTuple]. Поиск и слияние - векторные.
+    """
+
+    def __init__(
+        self, entries: Optional[Mapping[str, tuple[float, Optional[int], int]]] = None
+    ):
+        entries = entries or {}
+        keys = encode_uuids(list(entries))
+        order = np.argsort(keys, kind="stable")
+        traffic, user_ids, flags = self.__columns(entries.values())
+
+        self.uuids = keys[order]
+        self.traffic = traffic[order]
+        self.user_ids = user_ids[order]
+        self.flags = flags[order]
+
+    def __len__(self) -> int:
+        return len(self.uuids)
+
+    # (found, traffic, user_ids, flags) для uuids; там, где found == False,
+    # значения остальных колонок не имеют смысла
+    def lookup(self, uuids) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        keys = encode_uuids(uuids)
+
+        if not len(self.uuids):
+            empty = np.zeros(len(keys), dtype=bool)
+            return empty, np.zeros(len(keys)), np.zeros(len(keys), np.int64), empty
+
+        positions = np.minimum(np.searchsorted(self.uuids, keys), len(self.uuids) - 1)
+        found = self.uuids[positions] == keys
+
+        return (
+            found,
+            self.traffic[positions],
+            self.user_ids[positions],
+            self.flags[positions],
+        )
+
+    # Перезаписывает известные uuid, новые вставляет на свои места
+    def update(self, entries: Mapping[str, tuple[float, Optional[int], int]]) -> None:
+        if not entries:
+            return
+
+        keys = encode_uuids(list(entries))
+        traffic, user_ids, flags = self.__columns(entries.values())
+
+        if len(self.uuids):
+            positions = np.minimum(
+                np.searchsorted(self.uuids, keys), len(self.uuids) - 1
+            )
+            found = self.uuids[positions] == keys
+        else:
+            positions = np.zeros(len(keys), dtype=np.int64)
+            found = np.zeros(len(keys), dtype=bool)
+
+        known = positions[found]
+        self.traffic[known] = traffic[found]
+        self.user_ids[known] = user_ids[found]
+        self.flags[known] = flags[found]
+
+        new = ~found
+
+        if not new.any():
+            return
+
+        order = np.argsort(keys[new], kind="stable")
+        new_keys = keys[new][order]
+        at = np.searchsorted(self.uuids, new_keys)
+
+        width = np.result_type(self.uuids, new_keys)
+        self.uuids = np.insert(self.uuids.astype(width), at, new_keys)
+        self.traffic = np.insert(self.traffic, at, traffic[new][order])
+        self.user_ids = np.insert(self.user_ids, at, user_ids[new][order])
+        self.flags = np.insert(self.flags, at, flags[new][order])
+
+    @staticmethod
+    def __columns(
+        values: Iterable[tuple[float, Optional[int], int]],
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        traffic: list[float] = []
+        user_ids: list[int] = []
+        flags: list[int] = []
+
+        for entry_traffic, user_id, entry_flags in values:
+            traffic.append(entry_traffic)
+            user_ids.append(KNO_USER_ID if user_id is None else user_id)
+            flags.append(entry_flags)
+
+        return (
+            np.array(traffic, dtype=np.float64),
+            np.array(user_ids, dtype=np.int64),
+            np.array(flags, dtype=np.uint8),
+        )
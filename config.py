@@ -1,12 +1,39 @@
 import os
+from typing import Optional
 
 MI_UN_LOG_LEVEL = "MI_UN_LOG_LEVEL"
 MI_UN_SYNC_USER_PROGRESS = "MI_UN_SYNC_USER_PROGRESS"
 MI_UN_LOOP_INTERVAL = "MI_UN_LOOP_INTERVAL"
 
+# scheduler, intervals in minutes (MI_UN_LOOP_INTERVAL by default),
+# jitter in seconds (MI_UN_SCHEDULER_JITTER by default)
+MI_UN_SUBSCRIPTION_EXPIRATION_INTERVAL = "MI_UN_SUBSCRIPTION_EXPIRATION_INTERVAL"
+MI_UN_EXPIRED_USERS_INTERVAL = "MI_UN_EXPIRED_USERS_INTERVAL"
+MI_UN_NC_USERS_INTERVAL = "MI_UN_NC_USERS_INTERVAL"
+MI_UN_TRAFFIC_PROGRESS_INTERVAL = "MI_UN_TRAFFIC_PROGRESS_INTERVAL"
+MI_UN_SCHEDULER_JITTER = "MI_UN_SCHEDULER_JITTER"
+MI_UN_SUBSCRIPTION_EXPIRATION_JITTER = "MI_UN_SUBSCRIPTION_EXPIRATION_JITTER"
+MI_UN_EXPIRED_USERS_JITTER = "MI_UN_EXPIRED_USERS_JITTER"
+MI_UN_NC_USERS_JITTER = "MI_UN_NC_USERS_JITTER"
+MI_UN_TRAFFIC_PROGRESS_JITTER = "MI_UN_TRAFFIC_PROGRESS_JITTER"
+
+MI_UN_BONUS_CONCURRENCY = "MI_UN_BONUS_CONCURRENCY"
+MI_UN_PROGRESS_RECONCILE_INTERVAL = "MI_UN_PROGRESS_RECONCILE_INTERVAL"
+
+# metrics endpoint, disabled when the port is not set
+MI_UN_METRICS_HOST = "MI_UN_METRICS_HOST"
+MI_UN_METRICS_PORT = "MI_UN_METRICS_PORT"
+
 # MBMS
 MI_UN_RWMS_ADDR = "MI_UN_RWMS_ADDR"
 MI_UN_RWMS_PORT = "MI_UN_RWMS_PORT"
+MI_UN_RWMS_PAGE_SIZE = "MI_UN_RWMS_PAGE_SIZE"
+MI_UN_RWMS_MAX_IN_FLIGHT = "MI_UN_RWMS_MAX_IN_FLIGHT"
+MI_UN_RWMS_PAGE_RETRIES = "MI_UN_RWMS_PAGE_RETRIES"
+MI_UN_RWMS_STREAM_USERS = "MI_UN_RWMS_STREAM_USERS"
+MI_UN_RWMS_COLUMNAR_USERS = "MI_UN_RWMS_COLUMNAR_USERS"
+# processes decoding pages for the columnar mode, 0 - decode in the event loop
+MI_UN_RWMS_DECODE_WORKERS = "MI_UN_RWMS_DECODE_WORKERS"
 
 # postgres
 MI_UN_POSTGRES_HOST = "MI_UN_POSTGRES_HOST"
@@ -15,10 +42,29 @@ MI_UN_POSTGRES_USER = "MI_UN_POSTGRES_USER"
 MI_UN_POSTGRES_PASSWORD = "MI_UN_POSTGRES_PASSWORD"
 MI_UN_POSTGRES_DB = "MI_UN_POSTGRES_DB"
 
+# outbox: notifications are written to Postgres and drained to Redis
+MI_UN_OUTBOX = "MI_UN_OUTBOX"
+MI_UN_OUTBOX_BATCH_SIZE = "MI_UN_OUTBOX_BATCH_SIZE"
+MI_UN_OUTBOX_POLL_INTERVAL = "MI_UN_OUTBOX_POLL_INTERVAL"
+
 # redis
 MI_UN_REDIS_HOST = "MI_UN_REDIS_HOST"
 MI_UN_REDIS_PORT = "MI_UN_REDIS_PORT"
 MI_UN_REDIS_PASSWORD = "MI_UN_REDIS_PASSWORD"
+MI_UN_REDIS_BATCH_SIZE = "MI_UN_REDIS_BATCH_SIZE"
+# "list" (RPUSH, default) or "stream" (XADD with MAXLEN ~ MI_UN_REDIS_STREAM_MAXLEN)
+MI_UN_REDIS_BACKEND = "MI_UN_REDIS_BACKEND"
+MI_UN_REDIS_STREAM_MAXLEN = "MI_UN_REDIS_STREAM_MAXLEN"
+# "true": append each batch to all destination queues with one Lua script call
+MI_UN_REDIS_FANOUT = "MI_UN_REDIS_FANOUT"
+# "true": rate limit pushes per queue and hold back low-priority ones while a
+# queue is above MI_UN_REDIS_HIGH_WATER until it drains below MI_UN_REDIS_LOW_WATER
+MI_UN_REDIS_BACKPRESSURE = "MI_UN_REDIS_BACKPRESSURE"
+MI_UN_REDIS_HIGH_WATER = "MI_UN_REDIS_HIGH_WATER"
+MI_UN_REDIS_LOW_WATER = "MI_UN_REDIS_LOW_WATER"
+# messages per second per queue, 0 - no limit
+MI_UN_REDIS_RATE_LIMIT = "MI_UN_REDIS_RATE_LIMIT"
+MI_UN_REDIS_BACKPRESSURE_POLL = "MI_UN_REDIS_BACKPRESSURE_POLL"
 
 
 class Config:
@@ -40,6 +86,51 @@ class Config:
         else:
             self.loop_interval: int = int(loop_interval)
 
+        self.subscription_expiration_interval: float = float(
+            os.getenv(MI_UN_SUBSCRIPTION_EXPIRATION_INTERVAL) or self.loop_interval
+        )
+        self.expired_users_interval: float = float(
+            os.getenv(MI_UN_EXPIRED_USERS_INTERVAL) or self.loop_interval
+        )
+        self.nc_users_interval: float = float(
+            os.getenv(MI_UN_NC_USERS_INTERVAL) or self.loop_interval
+        )
+        self.traffic_progress_interval: float = float(
+            os.getenv(MI_UN_TRAFFIC_PROGRESS_INTERVAL) or self.loop_interval
+        )
+        self.scheduler_jitter: float = float(os.getenv(MI_UN_SCHEDULER_JITTER) or 0)
+        self.subscription_expiration_jitter: float = float(
+            os.getenv(MI_UN_SUBSCRIPTION_EXPIRATION_JITTER) or self.scheduler_jitter
+        )
+        self.expired_users_jitter: float = float(
+            os.getenv(MI_UN_EXPIRED_USERS_JITTER) or self.scheduler_jitter
+        )
+        self.nc_users_jitter: float = float(
+            os.getenv(MI_UN_NC_USERS_JITTER) or self.scheduler_jitter
+        )
+        self.traffic_progress_jitter: float = float(
+            os.getenv(MI_UN_TRAFFIC_PROGRESS_JITTER) or self.scheduler_jitter
+        )
+
+        bonus_concurrency = os.getenv(MI_UN_BONUS_CONCURRENCY)
+
+        if not bonus_concurrency:
+            self.bonus_concurrency: int = 10
+        else:
+            self.bonus_concurrency: int = int(bonus_concurrency)
+
+        # minutes between full traffic progress reconciliations
+        reconcile_interval = os.getenv(MI_UN_PROGRESS_RECONCILE_INTERVAL)
+
+        if not reconcile_interval:
+            self.progress_reconcile_interval: int = 360
+        else:
+            self.progress_reconcile_interval: int = int(reconcile_interval)
+
+        self.metrics_host: str = os.getenv(MI_UN_METRICS_HOST) or "0.0.0.0"
+        metrics_port = os.getenv(MI_UN_METRICS_PORT)
+        self.metrics_port: Optional[int] = int(metrics_port) if metrics_port else None
+
         # mbms envs
         self.rwms_address: str = os.getenv(MI_UN_RWMS_ADDR)
         self.rwms_port: int = int(os.getenv(MI_UN_RWMS_PORT))
@@ -50,6 +141,47 @@ class Config:
         if not self.rwms_port:
             raise ValueError(f"{MI_UN_RWMS_PORT} environment variable is not set.")
 
+        rwms_page_size = os.getenv(MI_UN_RWMS_PAGE_SIZE)
+
+        if not rwms_page_size:
+            self.rwms_page_size: int = 1000
+        else:
+            self.rwms_page_size: int = int(rwms_page_size)
+
+        rwms_max_in_flight = os.getenv(MI_UN_RWMS_MAX_IN_FLIGHT)
+
+        if not rwms_max_in_flight:
+            self.rwms_max_in_flight: int = 8
+        else:
+            self.rwms_max_in_flight: int = int(rwms_max_in_flight)
+
+        if self.rwms_max_in_flight <= 0:
+            raise ValueError(f"{MI_UN_RWMS_MAX_IN_FLIGHT} must be positive.")
+
+        rwms_page_retries = os.getenv(MI_UN_RWMS_PAGE_RETRIES)
+
+        if not rwms_page_retries:
+            self.rwms_page_retries: int = 3
+        else:
+            self.rwms_page_retries: int = int(rwms_page_retries)
+
+        stream_flag = os.getenv(MI_UN_RWMS_STREAM_USERS)
+        self.rwms_stream_users: bool = (
+            True if stream_flag and stream_flag.lower() == "true" else False
+        )
+
+        columnar_flag = os.getenv(MI_UN_RWMS_COLUMNAR_USERS)
+        self.rwms_columnar_users: bool = (
+            True if columnar_flag and columnar_flag.lower() == "true" else False
+        )
+
+        rwms_decode_workers = os.getenv(MI_UN_RWMS_DECODE_WORKERS)
+
+        if not rwms_decode_workers:
+            self.rwms_decode_workers: int = 0
+        else:
+            self.rwms_decode_workers: int = int(rwms_decode_workers)
+
         # redis envs
         self.redis_host: str = os.getenv(MI_UN_REDIS_HOST)
         self.redis_port: int = int(os.getenv(MI_UN_REDIS_PORT))
@@ -64,6 +196,82 @@ class Config:
         if not self.redis_password:
             raise ValueError(f"{MI_UN_REDIS_PASSWORD} environment variable is not set.")
 
+        redis_batch_size = os.getenv(MI_UN_REDIS_BATCH_SIZE)
+
+        if not redis_batch_size:
+            self.redis_batch_size: int = 1000
+        else:
+            self.redis_batch_size: int = int(redis_batch_size)
+
+        self.redis_backend: str = (os.getenv(MI_UN_REDIS_BACKEND) or "list").lower()
+
+        redis_stream_maxlen = os.getenv(MI_UN_REDIS_STREAM_MAXLEN)
+
+        if not redis_stream_maxlen:
+            self.redis_stream_maxlen: int = 1_000_000
+        else:
+            self.redis_stream_maxlen: int = int(redis_stream_maxlen)
+
+        redis_fanout_flag = os.getenv(MI_UN_REDIS_FANOUT)
+        self.redis_fanout: bool = (
+            True if redis_fanout_flag and redis_fanout_flag.lower() == "true" else False
+        )
+
+        backpressure_flag = os.getenv(MI_UN_REDIS_BACKPRESSURE)
+        self.redis_backpressure: bool = (
+            True if backpressure_flag and backpressure_flag.lower() == "true" else False
+        )
+
+        redis_high_water = os.getenv(MI_UN_REDIS_HIGH_WATER)
+
+        if not redis_high_water:
+            self.redis_high_water: int = 100_000
+        else:
+            self.redis_high_water: int = int(redis_high_water)
+
+        redis_low_water = os.getenv(MI_UN_REDIS_LOW_WATER)
+
+        if not redis_low_water:
+            self.redis_low_water: int = 20_000
+        else:
+            self.redis_low_water: int = int(redis_low_water)
+
+        if self.redis_low_water >= self.redis_high_water:
+            raise ValueError(
+                f"{MI_UN_REDIS_LOW_WATER} must be less than {MI_UN_REDIS_HIGH_WATER}."
+            )
+
+        redis_rate_limit = os.getenv(MI_UN_REDIS_RATE_LIMIT)
+
+        if not redis_rate_limit:
+            self.redis_rate_limit: float = 0
+        else:
+            self.redis_rate_limit: float = float(redis_rate_limit)
+
+        backpressure_poll = os.getenv(MI_UN_REDIS_BACKPRESSURE_POLL)
+
+        if not backpressure_poll:
+            self.redis_backpressure_poll: float = 5
+        else:
+            self.redis_backpressure_poll: float = float(backpressure_poll)
+
+        outbox_flag = os.getenv(MI_UN_OUTBOX)
+        self.outbox_enabled: bool = (
+            True if outbox_flag and outbox_flag.lower() == "true" else False
+        )
+
+        outbox_batch_size = os.getenv(MI_UN_OUTBOX_BATCH_SIZE)
+
+        if not outbox_batch_size:
+            self.outbox_batch_size: int = 5000
+        else:
+            self.outbox_batch_size: int = int(outbox_batch_size)
+
+        # seconds between polls when the outbox is drained
+        self.outbox_poll_interval: float = float(
+            os.getenv(MI_UN_OUTBOX_POLL_INTERVAL) or 1
+        )
+
         # postgres envs
         self.pg_host: str = os.getenv(MI_UN_POSTGRES_HOST)
         self.pg_port: int = int(os.getenv(MI_UN_POSTGRES_PORT))
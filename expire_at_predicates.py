@@ -0,0 +1,31 @@
+from datetime import timedelta
+from sqlalchemy import and_, func
+from sqlalchemy.sql.elements import ColumnElement
+from common.models.db import User
+
+# Все окна по expire_at записаны как диапазоны (expire_at > now() + x AND expire_at <= now() + y),
+# а не как expire_at - now() <= INTERVAL, чтобы Postgres мог использовать индекс по expire_at
+# (см. migrations/versions/0001_users_expire_at_index.py)
+
+
+def _now_plus(offset: timedelta) -> ColumnElement:
+    if not offset:
+        return func.now()
+
+    return func.now() + offset
+
+
+def expire_at_after(offset: timedelta = timedelta(0)) -> ColumnElement[bool]:
+    return and_(User.expire_at.isnot(None), User.expire_at > _now_plus(offset))
+
+
+def expire_at_not_after(offset: timedelta = timedelta(0)) -> ColumnElement[bool]:
+    return and_(User.expire_at.isnot(None), User.expire_at <= _now_plus(offset))
+
+
+def expire_at_between(lower: timedelta, upper: timedelta) -> ColumnElement[bool]:
+    return and_(
+        User.expire_at.isnot(None),
+        User.expire_at > _now_plus(lower),
+        User.expire_at <= _now_plus(upper),
+    )
@@ -1,8 +1,15 @@
 import logging
 import inspect
-from sqlalchemy import select, text, delete, func
+import numpy as np
+from typing import Callable, Awaitable, Optional
+from sqlalchemy import select, delete, exists
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from common.models.db import User, ExpiredUsersNotification
+from expire_at_predicates import expire_at_after, expire_at_not_after
+from metrics import DB_STATEMENT_DURATION
+from compact_state import IdSet
+
+KSTREAM_BATCH = 5000
 
 
 class ExpiredUsersFinder:
@@ -10,64 +17,70 @@ class ExpiredUsersFinder:
         self.__logger = logging.getLogger(self.__class__.__name__)
         self.__session_maker = session_maker
 
-    async def __get_expired_users(self, session: AsyncSession) -> set[int]:
-        expired = await session.execute(
-            select(User.telegram_id).where(
-                User.expire_at.isnot(None),
-                func.now() - User.expire_at >= text("INTERVAL '0 secs'"),
-            )
-        )
+    async def __get_users_to_notify(self, session: AsyncSession) -> IdSet:
+        already_notified = exists().where(ExpiredUsersNotification.user_id == User.id)
 
-        return set(row[0] for row in expired.fetchall())
+        chunks: list[np.ndarray] = []
 
-    async def __get_notified(self, session: AsyncSession) -> set[int]:
-        notified = await session.execute(
-            select(User.telegram_id).join(
-                ExpiredUsersNotification, ExpiredUsersNotification.user_id == User.id
+        with DB_STATEMENT_DURATION.labels(group="expired_candidates").time():
+            # Разницу считает Postgres (NOT EXISTS), результат читаем курсором батчами
+            stream = await session.stream(
+                select(User.telegram_id)
+                .where(
+                    expire_at_not_after(),
+                    ~already_notified,
+                )
+                .execution_options(yield_per=KSTREAM_BATCH)
             )
-        )
 
-        return set(row[0] for row in notified.fetchall())
+            async for partition in stream.partitions():
+                chunks.append(
+                    np.fromiter(
+                        (row[0] for row in partition),
+                        dtype=np.int64,
+                        count=len(partition),
+                    )
+                )
+
+        return IdSet(np.concatenate(chunks) if chunks else ())
 
     async def __validate_expired_users_notifications(
         self, session: AsyncSession
     ) -> None:
-        self.__logger.info(
-            "validated expired users notifications table (removed non-expired)"
-        )
+        no_longer_expired_users = select(User.id).where(expire_at_after())
 
-        no_longer_expired_users = select(User.id).where(
-            User.expire_at.isnot(None),
-            User.expire_at - func.now() > text("INTERVAL '0 secs'"),
-        )
-
-        await session.execute(
-            delete(ExpiredUsersNotification).where(
-                ExpiredUsersNotification.user_id.in_(no_longer_expired_users)
+        with DB_STATEMENT_DURATION.labels(group="expired_cleanup").time():
+            removed = await session.execute(
+                delete(ExpiredUsersNotification).where(
+                    ExpiredUsersNotification.user_id.in_(no_longer_expired_users)
+                )
             )
+
+        self.__logger.info(
+            f"validated expired users notifications table "
+            f"(removed {removed.rowcount} non-expired)"
         )
 
-    async def find(self) -> set[int]:
+    # on_found вызывается в транзакции поиска (например, чтобы записать outbox)
+    async def find(
+        self,
+        on_found: Optional[Callable[[AsyncSession, IdSet], Awaitable[None]]] = None,
+    ) -> IdSet:
         try:
             async with self.__session_maker() as session:
                 async with session.begin():
                     self.__logger.info("starting search for expired users to notify")
                     await self.__validate_expired_users_notifications(session=session)
 
-                    expired_users = await self.__get_expired_users(session=session)
-                    self.__logger.info(f"found {len(expired_users)} expired users")
-
-                    notified = await self.__get_notified(session=session)
-                    self.__logger.info(
-                        f"found {len(notified)} already notified expired users"
-                    )
-
-                    result = expired_users - notified
+                    result = await self.__get_users_to_notify(session=session)
                     self.__logger.info(
                         f"{len(result)} expired users require notifications"
                     )
 
+                    if on_found is not None:
+                        await on_found(session, result)
+
             return result
         except Exception:
             self.__logger.exception(f"error in {inspect.currentframe().f_code.co_name}")
-            return set()
+            return IdSet()
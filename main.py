@@ -1,9 +1,16 @@
 import time
 import asyncio
 import logging
+from functools import partial
 import proto.rwmanager_pb2 as proto
+from typing import Callable
+from typing import Awaitable
+from typing import Optional
+from typing import Union
+from typing import Any
 
 from sqlalchemy import select
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine
@@ -13,268 +20,781 @@ from common.rwms_client import RwmsClient
 from common.models.db import User
 from common.models.db import EventLog
 from common.models.messages import ConversionEvent
-from common.models.messages import NotificateUserMessage
-from common.models.messages import SendConversionMessage
 from common.models.messages import ReferralReachedTrafficBonusApplied
 from common.models.analytics_event import AnalyticsEvent
 from common.models.analytics_event import TrafficThresholdReached
 
 from config import Config
+from metrics import RWMS_USERS
+from metrics import STAGE_ERRORS
+from metrics import MetricsServer
+from metrics import STAGE_DURATION
+from metrics import FINDER_DURATION
+from metrics import DB_STATEMENT_DURATION
+from scheduler import Scheduler
 from redis_publisher import RedisPublisher
+from redis_publisher import PushBatchResult
+from redis_publisher import BOT_QUEUES
+from redis_publisher import YM_STAT_QUEUE
+from redis_publisher import serialize_message
+from queue_backpressure import KLOW_PRIORITY
+from message_templates import notification_payloads
+from message_templates import conversion_payloads
+from message_templates import build_templates
+from notification_outbox import OutboxDrainer
+from notification_outbox import NotificationOutbox
 from nc_users_finder import NcUsersFinder
+from rwms_users_fetcher import RwmsUsersFetcher
+from rwms_pages_decoder import RwmsPagesDecoder
+from users_snapshot import UsersSnapshot
+from users_snapshot import UsersSnapshotBuilder
 from expired_users_finder import ExpiredUsersFinder
+from compact_state import IdSet
+from user_traffic_progress_watcher import OnProgressApplied
 from user_traffic_progress_watcher import UserTrafficProgressWatcher
 from subscription_expiration_finder import SubscriptionExpirationFinder
 from subscription_expiration_finder import NotifyAboutSubscriptionExpiration
 
+KEVENT_LOG_BATCH = 5000
+# потоковый проход по RWMS ждет другую потоковую стадию, только если планировщик
+# запустит ее не позже чем через KSTREAM_JOIN_WINDOW секунд (плюс запас на старт)
+KSTREAM_JOIN_WINDOW = 1.0
+KSTREAM_JOIN_MARGIN = 0.1
+
+TRAFFIC_THRESHOLD_BY_CONVERSION = {
+    ConversionEvent.HAS_TRAFFIC: 0,
+    ConversionEvent.HAS_TRAFFIC_MORE_THAN_5MB: 5,
+    ConversionEvent.HAS_TRAFFIC_MORE_THAN_100MB: 100,
+}
+
+
+async def save_event_logs(
+    session: AsyncSession, events: list[tuple[str, AnalyticsEvent]]
+) -> int:
+    usernames = list({username for username, _ in events})
+    user_ids: dict[str, int] = {}
+
+    for start in range(0, len(usernames), KEVENT_LOG_BATCH):
+        result = await session.execute(
+            select(User.username, User.id).where(
+                User.username.in_(usernames[start : start + KEVENT_LOG_BATCH])
+            )
+        )
+        user_ids.update(result.tuples().all())
 
-async def save_event_log(
-    session: AsyncSession, event: AnalyticsEvent, username: str
-) -> None:
-    user_id = await session.scalar(
-        select(User.id).where(User.username == username).limit(1)
-    )
+    rows = []
+    unresolved = set()
+
+    for username, event in events:
+        user_id = user_ids.get(username)
 
-    if user_id is None:
-        logging.error(f"not fount user id for telegram id {event.telegram_id}")
-        return
+        if user_id is None:
+            unresolved.add(username)
+            continue
 
-    session.add(
-        EventLog(
-            user_id=user_id,
-            event_type=event.event_type,
-            event_payload=event.model_dump(),
+        rows.append(
+            {
+                "user_id": user_id,
+                "event_type": event.event_type,
+                "event_payload": event.model_dump(),
+            }
         )
-    )
 
+    if unresolved:
+        logging.error(
+            f"not found user ids for {len(unresolved)} usernames: {sorted(unresolved)[:20]}"
+        )
+
+    for start in range(0, len(rows), KEVENT_LOG_BATCH):
+        with DB_STATEMENT_DURATION.labels(group="event_logs").time():
+            await session.execute(
+                insert(EventLog).values(rows[start : start + KEVENT_LOG_BATCH])
+            )
+
+    return len(rows)
 
-async def save_traffic_threshold_reached_event_log(
-    session: AsyncSession, username: str, threshold: int
-):
-    event = TrafficThresholdReached(threshold=threshold)
-    await save_event_log(session, event, username)
+
+async def save_traffic_threshold_reached_event_logs(
+    session: AsyncSession, conversions: list[tuple[str, ConversionEvent]]
+) -> int:
+    events = [
+        (username, TrafficThresholdReached(threshold=threshold))
+        for username, event in conversions
+        if (threshold := TRAFFIC_THRESHOLD_BY_CONVERSION.get(event)) is not None
+    ]
+
+    return await save_event_logs(session, events)
+
+
+def log_push_result(what: str, result: PushBatchResult) -> None:
+    logging.info(f"pushed {what}: {result.pushed}")
+
+    if result.failed:
+        logging.error(
+            f"failed to push {len(result.failed)} {what} messages, "
+            f"first error: {result.failed[0].error}"
+        )
+
+
+def bonuses_applied_payloads(bonuses_applied: dict[int, int]) -> list[bytes]:
+    # бонусов мало и полей у сообщения несколько, шаблон здесь не нужен
+    return [
+        serialize_message(
+            ReferralReachedTrafficBonusApplied(
+                telegram_id=referrer_id,
+                referral_reached_traffic_count=referral_count,
+                bonus_days_count=referral_count * 10,
+            )
+        )
+        for referrer_id, referral_count in bonuses_applied.items()
+    ]
+
+
+def subscription_expiration_payloads(
+    to: NotifyAboutSubscriptionExpiration,
+) -> list[bytes]:
+    payloads = notification_payloads("1-day-left", to.one_day_left)
+    payloads.extend(notification_payloads("3-days-left", to.three_days_left))
+    return payloads
+
+
+def not_connected_payloads(to: set[int]) -> list[bytes]:
+    return notification_payloads("nc-yesterday-created", to)
+
+
+def expired_users_payloads(to: IdSet) -> list[bytes]:
+    return notification_payloads("subscription-expired", to)
 
 
 async def send_bonuses_applied_messages(
     bonuses_applied: dict[int, int], publisher: RedisPublisher
-):
-    for referrer_id, referral_count in bonuses_applied.items():
-        message = ReferralReachedTrafficBonusApplied(
-            telegram_id=referrer_id,
-            referral_reached_traffic_count=referral_count,
-            bonus_days_count=referral_count * 10,
-        )
-        await publisher.push_message_to_vpn_bot(message)
-        await publisher.push_message_to_vps_bot(message)
+) -> PushBatchResult:
+    payloads = bonuses_applied_payloads(bonuses_applied)
+
+    result = await publisher.push_payloads(payloads, BOT_QUEUES)
+    log_push_result("bonuses applied", result)
+    return result
 
 
 async def send_subscription_expiration_notifications(
     to: NotifyAboutSubscriptionExpiration, publisher: RedisPublisher
-):
-    for tg_id in to.one_day_left:
-        message = NotificateUserMessage(
-            service="monkey-island-vpn-bot",
-            type="notificate-user",
-            notification_type="1-day-left",
-            telegram_id=tg_id,
-        )
+) -> PushBatchResult:
+    payloads = subscription_expiration_payloads(to)
 
-        await publisher.push_message_to_vpn_bot(message)
-        await publisher.push_message_to_vps_bot(message)
+    result = await publisher.push_payloads(payloads, BOT_QUEUES)
+    log_push_result("subscription expiration", result)
+    return result
 
-    for tg_id in to.three_days_left:
-        message = NotificateUserMessage(
-            service="monkey-island-vpn-bot",
-            type="notificate-user",
-            notification_type="3-days-left",
-            telegram_id=tg_id,
-        )
 
-        await publisher.push_message_to_vpn_bot(message)
-        await publisher.push_message_to_vps_bot(message)
+async def send_not_connected_notifications(
+    to: set[int], publisher: RedisPublisher
+) -> PushBatchResult:
+    payloads = not_connected_payloads(to)
 
+    # напоминание не срочное, при отстающих ботах ждет, пока очереди разгрузятся
+    result = await publisher.push_payloads(payloads, BOT_QUEUES, KLOW_PRIORITY)
+    log_push_result("not connected", result)
+    return result
 
-async def send_not_connected_notifications(to: set[int], publisher: RedisPublisher):
-    for tg_id in to:
-        message = NotificateUserMessage(
-            service="monkey-island-vpn-bot",
-            type="notificate-user",
-            notification_type="nc-yesterday-created",
-            telegram_id=tg_id,
-        )
 
-        await publisher.push_message_to_vpn_bot(message)
-        await publisher.push_message_to_vps_bot(message)
+async def send_expired_users_notifications(
+    to: IdSet, publisher: RedisPublisher
+) -> PushBatchResult:
+    payloads = expired_users_payloads(to)
 
+    result = await publisher.push_payloads(payloads, BOT_QUEUES)
+    log_push_result("subscription expired", result)
+    return result
 
-async def send_expired_users_notifications(to: set[int], publisher: RedisPublisher):
-    for tg_id in to:
-        message = NotificateUserMessage(
-            service="monkey-island-vpn-bot",
-            type="notificate-user",
-            notification_type="subscription-expired",
-            telegram_id=tg_id,
-        )
 
-        await publisher.push_message_to_vpn_bot(message)
-        await publisher.push_message_to_vps_bot(message)
+async def send_traffic_ym_conversion_events(
+    conversions: list[tuple[str, ConversionEvent]], publisher: RedisPublisher
+) -> PushBatchResult:
+    payloads = conversion_payloads(conversions)
 
+    result = await publisher.push_payloads(payloads, [YM_STAT_QUEUE])
+    log_push_result("YM conversions", result)
 
-async def send_traffic_ym_conversion_event(
-    username: str, event: ConversionEvent, publisher: RedisPublisher
-):
-    try:
-        logging.info(f"sending {event} conversion for {username}")
+    for failure in result.failed:
+        username, event = conversions[failure.index]
+        logging.error(f"pushing {event} YM conversion failed for {username}")
+
+    return result
 
-        msg = SendConversionMessage(
-            service="monkey-island-ym-stat",
-            type="send-conversion",
-            client_id=username,
-            event=event,
-        )
 
-        await publisher.push_message_to_ym_stat(message=msg)
-        logging.info(f"{event} conversion for {username} has been sent")
+async def rwms_get_all_users(fetcher: RwmsUsersFetcher) -> list[proto.UserResponse]:
+    try:
+        return await fetcher.fetch_all()
+    except Exception as e:
+        logging.error(f"error fetching users from RWMS: {e}")
+        return []
 
-    except Exception:
-        logging.exception(f"pushing {event} YM conversions task error for {username}")
 
+async def rwms_stream_users(
+    fetcher: RwmsUsersFetcher,
+    nc_users_finder: Optional[NcUsersFinder],
+    user_traffic_progress_watcher: Optional[UserTrafficProgressWatcher],
+) -> int:
+    users_count = 0
 
-async def rwms_get_all_users(rwms: RwmsClient) -> list[proto.UserResponse]:
     try:
-        offset = 0
-        count = 1000
-        response = await rwms.get_all_users(offset=offset, count=count)
+        if nc_users_finder is not None:
+            await nc_users_finder.begin()
+
+        if user_traffic_progress_watcher is not None:
+            await user_traffic_progress_watcher.begin()
+
+        async for page in fetcher.iter_pages():
+            users_count += len(page)
+
+            if nc_users_finder is not None:
+                nc_users_finder.scan(page)
 
-        result: list = list()
-        result.extend(response.users)
+            if user_traffic_progress_watcher is not None:
+                await user_traffic_progress_watcher.scan(page)
 
-        while len(result) < response.total:
-            offset += count
-            response = await rwms.get_all_users(offset=offset, count=count)
-            result.extend(response.users)
+        return users_count
+    except Exception as e:
+        logging.error(f"error streaming users from RWMS: {e}")
+        return 0
+
+
+async def rwms_get_users_snapshot(
+    fetcher: RwmsUsersFetcher, decoded: bool = False
+) -> UsersSnapshot:
+    builder = UsersSnapshotBuilder()
 
-        return result
+    try:
+        if decoded:
+            # страницы уже разобраны в колонки в процессах RwmsPagesDecoder
+            async for page in fetcher.iter_replies():
+                builder.add_columns(page.columns)
+        else:
+            async for page in fetcher.iter_pages():
+                builder.add_page(page)
     except Exception as e:
         logging.error(f"error fetching users from RWMS: {e}")
-        return []
+        builder = UsersSnapshotBuilder()
+
+    return builder.build()
+
+
+class SharedUsersStream:
+    """Один потоковый проход по RWMS и стадии, которые успели к нему присоединиться."""
+
+    def __init__(self):
+        self.nc_users = False
+        self.traffic_progress = False
+        self.started = False
+        self.task: Optional[asyncio.Task] = None
+
+
+class UserNotifyStages:
+    """
+    Стадии одной итерации. Зависимости между ними:
+
+        subscription expiration  (только БД)
+        expired users            (только БД)
+        rwms users -> not connected users
+                   -> traffic progress
+
+    Независимые стадии выполняются параллельно, ошибка одной стадии логируется
+    и не отменяет остальные.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        session_maker: async_sessionmaker,
+        publisher: RedisPublisher,
+        scheduler: Optional[Scheduler] = None,
+    ):
+        self.__config = config
+        self.__session_maker = session_maker
+        self.__publisher = publisher
+        self.__scheduler = scheduler
+
+        # несовпадение шаблона с моделью - ValueError здесь, при старте
+        build_templates()
+
+        self.__rwms = RwmsClient(addr=config.rwms_address, port=config.rwms_port)
+        self.__rwms_users_fetcher = RwmsUsersFetcher(
+            rwms=self.__rwms,
+            page_size=config.rwms_page_size,
+            max_in_flight=config.rwms_max_in_flight,
+            page_retries=config.rwms_page_retries,
+        )
 
+        self.__rwms_pages_decoder: Optional[RwmsPagesDecoder] = None
+        self.__rwms_decoded_users_fetcher: Optional[RwmsUsersFetcher] = None
 
-async def main(
-    config: Config,
-    session_maker: async_sessionmaker,
-    publisher: RedisPublisher,
-) -> None:
-    rwms = RwmsClient(addr=config.rwms_address, port=config.rwms_port)
+        if config.rwms_columnar_users and config.rwms_decode_workers > 0:
+            self.__rwms_pages_decoder = RwmsPagesDecoder(
+                addr=config.rwms_address,
+                port=config.rwms_port,
+                workers=config.rwms_decode_workers,
+            )
+            self.__rwms_decoded_users_fetcher = RwmsUsersFetcher(
+                rwms=self.__rwms_pages_decoder,
+                page_size=config.rwms_page_size,
+                max_in_flight=config.rwms_max_in_flight,
+                page_retries=config.rwms_page_retries,
+            )
 
-    user_traffic_progress_watcher = UserTrafficProgressWatcher(
-        sync_user_progress=config.sync_user_progress, session_maker=session_maker
-    )
+        self.__user_traffic_progress_watcher = UserTrafficProgressWatcher(
+            sync_user_progress=config.sync_user_progress,
+            session_maker=session_maker,
+            bonus_concurrency=config.bonus_concurrency,
+            reconcile_interval=config.progress_reconcile_interval,
+        )
 
-    nc_users_finder = NcUsersFinder(session_maker=session_maker)
-    expired_users_finder = ExpiredUsersFinder(session_maker=session_maker)
-    subscription_expiration_finder = SubscriptionExpirationFinder(
-        session_maker=session_maker
-    )
+        self.__nc_users_finder = NcUsersFinder(session_maker=session_maker)
+        self.__expired_users_finder = ExpiredUsersFinder(session_maker=session_maker)
+        self.__subscription_expiration_finder = SubscriptionExpirationFinder(
+            session_maker=session_maker
+        )
 
-    logging.info("user notification service started")
-    logging.info(
-        f"DB: {config.pg_host}:{config.pg_port}/{config.pg_db}, Redis: {config.redis_host}:{config.redis_port}"
-    )
-    logging.info(f"loop interval: {config.loop_interval}m")
+        # с outbox сообщения пишутся в транзакциях finder'ов, в Redis их переносит OutboxDrainer
+        self.__outbox: Optional[NotificationOutbox] = (
+            NotificationOutbox() if config.outbox_enabled else None
+        )
+
+        self.__users_task: Optional[asyncio.Task] = None
+        self.__users_stream: Optional[SharedUsersStream] = None
 
-    while True:
-        start_time = time.monotonic()
+    async def close(self) -> None:
+        if self.__rwms_pages_decoder is not None:
+            await self.__rwms_pages_decoder.close()
+
+    async def run_stage(self, name: str, stage: Callable[[], Awaitable[None]]) -> None:
+        t0 = time.monotonic()
 
         try:
-            # subscription expiration
-            t0 = time.monotonic()
-            telegram_ids = await subscription_expiration_finder.find()
+            await stage()
+        except Exception:
+            STAGE_ERRORS.labels(stage=name).inc()
+            logging.exception(f"{name} stage error")
+
+        duration = time.monotonic() - t0
+        STAGE_DURATION.labels(stage=name).observe(duration)
+
+        logging.info(f"{name} stage finished in {duration:.2f}s")
+
+    async def subscription_expiration_stage(self) -> None:
+        t0 = time.monotonic()
 
-            logging.info(
-                f"found {len(telegram_ids.one_day_left)} users with 1-day-left and "
-                f"{len(telegram_ids.three_days_left)} with 3-days-left (took {time.monotonic()-t0:.2f}s)"
+        with FINDER_DURATION.labels(finder="subscription expiration").time():
+            telegram_ids = await self.__subscription_expiration_finder.find(
+                on_found=self.__outbox_writer(
+                    "subscription expiration",
+                    subscription_expiration_payloads,
+                    BOT_QUEUES,
+                )
             )
 
+        logging.info(
+            f"found {len(telegram_ids.one_day_left)} users with 1-day-left and "
+            f"{len(telegram_ids.three_days_left)} with 3-days-left (took {time.monotonic()-t0:.2f}s)"
+        )
+
+        if self.__outbox is None:
             await send_subscription_expiration_notifications(
-                to=telegram_ids, publisher=publisher
+                to=telegram_ids, publisher=self.__publisher
+            )
+
+    async def expired_users_stage(self) -> None:
+        t0 = time.monotonic()
+
+        with FINDER_DURATION.labels(finder="expired users").time():
+            expired = await self.__expired_users_finder.find(
+                on_found=self.__outbox_writer(
+                    "subscription expired", expired_users_payloads, BOT_QUEUES
+                )
             )
 
-            # expired users
-            t0 = time.monotonic()
-            expired = await expired_users_finder.find()
+        logging.info(
+            f"found {len(expired)} expired users (took {time.monotonic()-t0:.2f}s)"
+        )
 
-            logging.info(
-                f"found {len(expired)} expired users (took {time.monotonic()-t0:.2f}s)"
+        if self.__outbox is None:
+            await send_expired_users_notifications(
+                to=expired, publisher=self.__publisher
             )
-            await send_expired_users_notifications(to=expired, publisher=publisher)
 
-            all_users = await rwms_get_all_users(rwms)
+    async def nc_users_stage(self) -> None:
+        t0 = time.monotonic()
+
+        if self.__config.rwms_stream_users:
+            users_count = await self.__stream_users(nc_users=True)
 
-            if len(all_users) == 0:
-                logging.info("failed to fetch active users from RWMS")
-                continue
+            if self.__log_fetched_users(users_count, t0):
+                await self.__notify_nc_users(self.__nc_users_finder.finish())
 
-            logging.info(f"fetched {len(all_users)} active users from RWMS")
+            return
 
-            if not len(all_users):
-                continue
+        users = await self.__get_users()
 
-            # not connected users
-            t0 = time.monotonic()
-            nc_users_to_notify = await nc_users_finder.find(users=all_users)
+        if self.__log_fetched_users(len(users), t0):
+            await self.__nc_users_from(users)
 
-            logging.info(
-                f"found {len(nc_users_to_notify)} not connected users (took {time.monotonic()-t0:.2f}s)"
-            )
-            await send_not_connected_notifications(
-                to=nc_users_to_notify, publisher=publisher
-            )
+    async def traffic_progress_stage(self) -> None:
+        t0 = time.monotonic()
 
-            # user traffic progress check
-            conversions_to_send, bonuses_applied = (
-                await user_traffic_progress_watcher.find(rwms, all_users)
-            )
+        if self.__config.rwms_stream_users:
+            watcher = self.__user_traffic_progress_watcher
+            users_count = await self.__stream_users(traffic_progress=True)
+
+            if self.__log_fetched_users(users_count, t0):
+                with FINDER_DURATION.labels(finder="traffic progress").time():
+                    result = await watcher.finish(
+                        self.__rwms, self.__traffic_progress_writer()
+                    )
+
+                await self.__handle_traffic_progress(*result)
+
+            return
+
+        users = await self.__get_users()
+
+        if self.__log_fetched_users(len(users), t0):
+            await self.__traffic_progress_from(users)
+
+    def __log_fetched_users(self, users_count: int, t0: float) -> bool:
+        if users_count == 0:
+            logging.info("failed to fetch active users from RWMS")
+            return False
+
+        RWMS_USERS.set(users_count)
+
+        logging.info(
+            f"fetched {users_count} active users from RWMS (took {time.monotonic()-t0:.2f}s)"
+        )
+        return True
 
-            # Отправляем уведомление о бонусах
-            await send_bonuses_applied_messages(
-                bonuses_applied=bonuses_applied, publisher=publisher
+    # Стадии, запущенные одновременно, разделяют одну выборку пользователей RWMS
+    async def __get_users(self) -> Union[list[proto.UserResponse], UsersSnapshot]:
+        task = self.__users_task
+
+        if task is None or task.done():
+            task = asyncio.create_task(self.__fetch_users())
+            task.add_done_callback(self.__release_users_task)
+            self.__users_task = task
+
+        return await asyncio.shield(task)
+
+    # Потоковый режим: стадии присоединяются к одному проходу по RWMS, пока он
+    # не начался. Проход стартует сразу, если другой потоковой стадии планировщик
+    # не запустит в ближайшие KSTREAM_JOIN_WINDOW секунд; стадия, пришедшая позже
+    # (например, из-за jitter), делает свой проход.
+    async def __stream_users(
+        self, nc_users: bool = False, traffic_progress: bool = False
+    ) -> int:
+        stream = self.__users_stream
+
+        if stream is None or stream.started:
+            stream = SharedUsersStream()
+            stream.task = asyncio.create_task(self.__run_users_stream(stream))
+            self.__users_stream = stream
+
+        stream.nc_users |= nc_users
+        stream.traffic_progress |= traffic_progress
+
+        return await asyncio.shield(stream.task)
+
+    async def __run_users_stream(self, stream: SharedUsersStream) -> int:
+        wait = self.__stream_join_wait(stream)
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        stream.started = True
+
+        try:
+            consumers = [
+                name
+                for name, joined in (
+                    ("not connected users", stream.nc_users),
+                    ("traffic progress", stream.traffic_progress),
+                )
+                if joined
+            ]
+            logging.info(f"streaming RWMS users for {', '.join(consumers)}")
+
+            return await rwms_stream_users(
+                self.__rwms_users_fetcher,
+                self.__nc_users_finder if stream.nc_users else None,
+                (
+                    self.__user_traffic_progress_watcher
+                    if stream.traffic_progress
+                    else None
+                ),
+            )
+        finally:
+            if self.__users_stream is stream:
+                self.__users_stream = None
+
+    # Сколько ждать потоковые стадии, которые еще не присоединились, но вот-вот
+    # получат тик планировщика; 0 - никто не подойдет, начинаем сразу
+    def __stream_join_wait(self, stream: SharedUsersStream) -> float:
+        if self.__scheduler is None:
+            return 0.0
+
+        waits = [
+            due
+            for name, joined in (
+                ("not connected users", stream.nc_users),
+                ("traffic progress", stream.traffic_progress),
+            )
+            if not joined
+            and (due := self.__scheduler.due_in(name)) is not None
+            and due <= KSTREAM_JOIN_WINDOW
+        ]
+
+        return max(waits) + KSTREAM_JOIN_MARGIN if waits else 0.0
+
+    def __release_users_task(self, task: asyncio.Task) -> None:
+        # не держим выборку в памяти после того, как ее разобрали ожидающие стадии
+        if self.__users_task is task:
+            self.__users_task = None
+
+    async def __fetch_users(self) -> Union[list[proto.UserResponse], UsersSnapshot]:
+        if self.__rwms_decoded_users_fetcher is not None:
+            # pages are decoded into columns in the process pool, off the event loop
+            return await rwms_get_users_snapshot(
+                self.__rwms_decoded_users_fetcher, decoded=True
             )
 
-            for username, event in conversions_to_send:
-                await send_traffic_ym_conversion_event(
-                    username=username, event=event, publisher=publisher
+        if self.__config.rwms_columnar_users:
+            # one columnar snapshot per cycle, rules are evaluated as vectorized masks
+            return await rwms_get_users_snapshot(self.__rwms_users_fetcher)
+
+        return await rwms_get_all_users(self.__rwms_users_fetcher)
+
+    async def __nc_users_from(
+        self, users: Union[list[proto.UserResponse], UsersSnapshot]
+    ) -> None:
+        nc_users_finder = self.__nc_users_finder
+
+        with FINDER_DURATION.labels(finder="not connected users").time():
+            if isinstance(users, UsersSnapshot):
+                await nc_users_finder.begin()
+                nc_users_finder.scan_snapshot(users)
+                nc_users_to_notify = nc_users_finder.finish()
+            else:
+                nc_users_to_notify = await nc_users_finder.find(users=users)
+
+        await self.__notify_nc_users(nc_users_to_notify)
+
+    async def __traffic_progress_from(
+        self, users: Union[list[proto.UserResponse], UsersSnapshot]
+    ) -> None:
+        watcher = self.__user_traffic_progress_watcher
+
+        with FINDER_DURATION.labels(finder="traffic progress").time():
+            if isinstance(users, UsersSnapshot):
+                await watcher.begin()
+                await watcher.scan_snapshot(users)
+                result = await watcher.finish(
+                    self.__rwms, self.__traffic_progress_writer()
                 )
+            else:
+                result = await watcher.find(
+                    self.__rwms, users, self.__traffic_progress_writer()
+                )
+
+        if result is not None:
+            await self.__handle_traffic_progress(*result)
 
-            async with session_maker() as session:
+    async def __notify_nc_users(self, nc_users_to_notify: set[int]) -> None:
+        logging.info(f"found {len(nc_users_to_notify)} not connected users")
+
+        if self.__outbox is not None:
+            # состояние этой стадии в БД не меняется, outbox пишется отдельной транзакцией
+            async with self.__session_maker() as session:
                 async with session.begin():
-                    try:
-                        for username, event in conversions_to_send:
-                            if event == ConversionEvent.HAS_TRAFFIC:
-                                await save_traffic_threshold_reached_event_log(
-                                    session, username, 0
-                                )
-                            if event == ConversionEvent.HAS_TRAFFIC_MORE_THAN_5MB:
-                                await save_traffic_threshold_reached_event_log(
-                                    session, username, 5
-                                )
-                            if event == ConversionEvent.HAS_TRAFFIC_MORE_THAN_100MB:
-                                await save_traffic_threshold_reached_event_log(
-                                    session, username, 100
-                                )
-                    except Exception as e:
-                        logging.error(f"save event log error: {e}")
-
-        except (asyncio.CancelledError, KeyboardInterrupt):
-            logging.info("received shutdown signal")
+                    count = await self.__outbox.add(
+                        session, not_connected_payloads(nc_users_to_notify), BOT_QUEUES
+                    )
+
+            logging.info(f"queued {count} not connected outbox messages")
             return
-        except Exception:
-            logging.exception(f"main iteration error")
 
-        duration = time.monotonic() - start_time
-        logging.info(f"iteration finished in {duration:.2f}s")
+        await send_not_connected_notifications(
+            to=nc_users_to_notify, publisher=self.__publisher
+        )
+
+    def __outbox_writer(
+        self,
+        what: str,
+        make_payloads: Callable[[Any], list[bytes]],
+        queues: list[str],
+    ) -> Optional[Callable[[AsyncSession, Any], Awaitable[None]]]:
+        if self.__outbox is None:
+            return None
+
+        async def write(session: AsyncSession, found: Any) -> None:
+            count = await self.__outbox.add(session, make_payloads(found), queues)
+            logging.info(f"queued {count} {what} outbox messages")
+
+        return write
+
+    def __traffic_progress_writer(self) -> Optional[OnProgressApplied]:
+        if self.__outbox is None:
+            return None
+
+        return self.__write_traffic_progress
+
+    async def __write_traffic_progress(
+        self,
+        session: AsyncSession,
+        conversions: list[tuple[str, ConversionEvent]],
+        bonuses_applied: dict[int, int],
+    ) -> None:
+        bonuses_count = await self.__outbox.add(
+            session, bonuses_applied_payloads(bonuses_applied), BOT_QUEUES
+        )
+        conversions_count = await self.__outbox.add(
+            session, conversion_payloads(conversions), [YM_STAT_QUEUE]
+        )
+        logging.info(
+            f"queued {bonuses_count} bonuses applied and {conversions_count} YM "
+            f"outbox messages"
+        )
+
+        # как и без outbox, ошибка журнала событий не откатывает прогресс:
+        # откатывается только savepoint
+        try:
+            async with session.begin_nested():
+                saved_count = await save_traffic_threshold_reached_event_logs(
+                    session, conversions
+                )
+            logging.info(f"saved {saved_count} traffic event logs")
+        except Exception as e:
+            logging.error(f"save event log error: {e}")
+
+    async def __handle_traffic_progress(
+        self,
+        conversions_to_send: list[tuple[str, ConversionEvent]],
+        bonuses_applied: dict[int, int],
+    ) -> None:
+        # с outbox все уже записано в транзакции watcher'а
+        if self.__outbox is not None:
+            return
 
-        await asyncio.sleep(60 * config.loop_interval)
+        # Отправляем уведомление о бонусах
+        await send_bonuses_applied_messages(
+            bonuses_applied=bonuses_applied, publisher=self.__publisher
+        )
+
+        await send_traffic_ym_conversion_events(
+            conversions=conversions_to_send, publisher=self.__publisher
+        )
+
+        async with self.__session_maker() as session:
+            async with session.begin():
+                try:
+                    saved_count = await save_traffic_threshold_reached_event_logs(
+                        session, conversions_to_send
+                    )
+                    logging.info(f"saved {saved_count} traffic event logs")
+                except Exception as e:
+                    logging.error(f"save event log error: {e}")
+
+
+# Стадии, которые main() ставит в планировщик:
+# (имя, интервал в минутах, jitter в секундах, стадия)
+def scheduled_stages(
+    config: Config, stages: UserNotifyStages
+) -> list[tuple[str, float, float, Callable[[], Awaitable[None]]]]:
+    return [
+        (
+            "subscription expiration",
+            config.subscription_expiration_interval,
+            config.subscription_expiration_jitter,
+            stages.subscription_expiration_stage,
+        ),
+        (
+            "expired users",
+            config.expired_users_interval,
+            config.expired_users_jitter,
+            stages.expired_users_stage,
+        ),
+        (
+            "not connected users",
+            config.nc_users_interval,
+            config.nc_users_jitter,
+            stages.nc_users_stage,
+        ),
+        (
+            "traffic progress",
+            config.traffic_progress_interval,
+            config.traffic_progress_jitter,
+            stages.traffic_progress_stage,
+        ),
+    ]
+
+
+async def main(
+    config: Config,
+    session_maker: async_sessionmaker,
+    publisher: RedisPublisher,
+) -> None:
+    scheduler = Scheduler()
+    stages = UserNotifyStages(
+        config=config,
+        session_maker=session_maker,
+        publisher=publisher,
+        scheduler=scheduler,
+    )
+
+    logging.info("user notification service started")
+    logging.info(
+        f"DB: {config.pg_host}:{config.pg_port}/{config.pg_db}, Redis: {config.redis_host}:{config.redis_port}"
+    )
+
+    if config.redis_fanout:
+        await publisher.load_scripts()
+
+    metrics_server = None
+
+    if config.metrics_port is not None:
+        metrics_server = MetricsServer(
+            host=config.metrics_host, port=config.metrics_port
+        )
+        await metrics_server.start()
+
+    for name, interval, jitter, stage in scheduled_stages(config, stages):
+        scheduler.register(
+            name=name,
+            interval=60 * interval,
+            jitter=jitter,
+            job=partial(stages.run_stage, name, stage),
+        )
+
+    drainer = None
+
+    if config.outbox_enabled:
+        drainer = OutboxDrainer(
+            session_maker=session_maker,
+            publisher=publisher,
+            batch_size=config.outbox_batch_size,
+            poll_interval=config.outbox_poll_interval,
+        )
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(scheduler.run())
+
+            if drainer is not None:
+                # публикует из outbox непрерывно, независимо от итераций
+                tg.create_task(drainer.run())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        logging.info("received shutdown signal")
+    finally:
+        await stages.close()
+
+        if metrics_server is not None:
+            await metrics_server.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+import orjson
+from functools import lru_cache
+from typing import Any, Callable, Iterable
+from pydantic import BaseModel
+from common.models.messages import ConversionEvent
+from common.models.messages import NotificateUserMessage
+from common.models.messages import SendConversionMessage
+
+# значения-заглушки, которые не могут встретиться в остальных полях шаблона
+KSENTINEL_INT = 7_349_216_580_113_429
+KSENTINEL_STR = "__mi_un_template_sentinel__"
+# значения для самопроверки шаблона; строка - с символами, которые экранирует JSON
+KPROBE_INT = 1_234_567_890
+KPROBE_STR = 'probe "1234567890" \\ проба'
+# типы уведомлений, которые рендерятся по шаблону (см. build_templates)
+KNOTIFICATION_TYPES = (
+    "1-day-left",
+    "3-days-left",
+    "nc-yesterday-created",
+    "subscription-expired",
+)
+
+
+def make_notification(notification_type: str, tg_id: int) -> NotificateUserMessage:
+    return NotificateUserMessage(
+        service="monkey-island-vpn-bot",
+        type="notificate-user",
+        notification_type=notification_type,
+        telegram_id=tg_id,
+    )
+
+
+class MessageTemplate:
+    """
+    Сообщение, один раз сериализованное через pydantic + orjson с заглушкой
+    в поле field и разрезанное по ней: на каждое сообщение остается только
+    склеить prefix + значение + suffix, без валидации и model_dump().
+
+    build(value) собирает модель так же, как без шаблона. При создании шаблон
+    рендерит probe и сверяет результат с orjson.dumps(build(probe).model_dump()),
+    так что расхождение с моделью (например, новое поле с зависимостью от
+    значения) дает ValueError сразу, а не неверные payload'ы.
+    """
+
+    def __init__(
+        self,
+        build: Callable[[Any], BaseModel],
+        field: str,
+        sentinel: Any,
+        probe: Any,
+    ):
+        data = orjson.dumps(build(sentinel).model_dump())
+        token = orjson.dumps(field) + b":" + orjson.dumps(sentinel)
+
+        if data.count(token) != 1:
+            raise ValueError(f"can't build template for {field} from {data!r}")
+
+        self.prefix, _, self.suffix = data.partition(token)
+        self.prefix += orjson.dumps(field) + b":"
+
+        render = self.render_int if isinstance(sentinel, int) else self.render_str
+        expected = orjson.dumps(build(probe).model_dump())
+
+        if render(probe) != expected:
+            raise ValueError(
+                f"template for {field} renders {render(probe)!r}, model gives {expected!r}"
+            )
+
+    def render_int(self, value: int) -> bytes:
+        return b"%s%d%s" % (self.prefix, value, self.suffix)
+
+    def render_str(self, value: str) -> bytes:
+        return self.prefix + orjson.dumps(value) + self.suffix
+
+
+@lru_cache(maxsize=None)
+def notification_template(notification_type: str) -> MessageTemplate:
+    return MessageTemplate(
+        lambda tg_id: make_notification(notification_type, tg_id),
+        "telegram_id",
+        KSENTINEL_INT,
+        KPROBE_INT,
+    )
+
+
+@lru_cache(maxsize=None)
+def conversion_template(event: ConversionEvent) -> MessageTemplate:
+    return MessageTemplate(
+        lambda client_id: SendConversionMessage(
+            service="monkey-island-ym-stat",
+            type="send-conversion",
+            client_id=client_id,
+            event=event,
+        ),
+        "client_id",
+        KSENTINEL_STR,
+        KPROBE_STR,
+    )
+
+
+# Строит все шаблоны заранее: их самопроверка падает при старте сервиса,
+# а не посреди стадии на первой отправке
+def build_templates() -> None:
+    for notification_type in KNOTIFICATION_TYPES:
+        notification_template(notification_type)
+
+    for event in ConversionEvent:
+        conversion_template(event)
+
+
+def notification_payloads(
+    notification_type: str, telegram_ids: Iterable[int]
+) -> list[bytes]:
+    render = notification_template(notification_type).render_int
+    return [render(tg_id) for tg_id in telegram_ids]
+
+
+def conversion_payloads(
+    conversions: Iterable[tuple[str, ConversionEvent]],
+) -> list[bytes]:
+    return [
+        conversion_template(event).render_str(username)
+        for username, event in conversions
+    ]
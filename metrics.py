@@ -0,0 +1,162 @@
+import os
+import asyncio
+import logging
+import resource
+from threading import Thread
+from typing import Optional
+from wsgiref.simple_server import WSGIServer
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import start_http_server
+
+KDEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+def current_rss_bytes() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss - пиковое значение в KiB (Linux), лучше чем ничего
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# свой registry без process_/python_ коллекторов по умолчанию
+REGISTRY = CollectorRegistry()
+
+STAGE_DURATION = Histogram(
+    "user_notify_stage_duration_seconds",
+    "Duration of a stage run",
+    ("stage",),
+    registry=REGISTRY,
+    buckets=KDEFAULT_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "user_notify_stage_errors_total",
+    "Stage runs that raised",
+    ("stage",),
+    registry=REGISTRY,
+)
+FINDER_DURATION = Histogram(
+    "user_notify_finder_duration_seconds",
+    "Time spent finding users to notify, without publishing",
+    ("finder",),
+    registry=REGISTRY,
+    buckets=KDEFAULT_BUCKETS,
+)
+RWMS_PAGE_DURATION = Histogram(
+    "user_notify_rwms_page_duration_seconds",
+    "Duration of one GetAllUsers page",
+    registry=REGISTRY,
+    buckets=KDEFAULT_BUCKETS,
+)
+RWMS_PAGE_ERRORS = Counter(
+    "user_notify_rwms_page_errors_total",
+    "Failed GetAllUsers page requests",
+    registry=REGISTRY,
+)
+DB_STATEMENT_DURATION = Histogram(
+    "user_notify_db_statement_duration_seconds",
+    "Duration of a group of DB statements",
+    ("group",),
+    registry=REGISTRY,
+    buckets=KDEFAULT_BUCKETS,
+)
+REDIS_PUSH_DURATION = Histogram(
+    "user_notify_redis_push_batch_duration_seconds",
+    "Duration of one pipelined Redis push batch",
+    registry=REGISTRY,
+    buckets=KDEFAULT_BUCKETS,
+)
+MESSAGES_PUBLISHED = Counter(
+    "user_notify_messages_published_total",
+    "Messages pushed to Redis",
+    ("queue",),
+    registry=REGISTRY,
+)
+MESSAGES_FAILED = Counter(
+    "user_notify_messages_failed_total",
+    "Messages failed to push",
+    ("queue",),
+    registry=REGISTRY,
+)
+USERS_SCANNED = Counter(
+    "user_notify_users_scanned_total",
+    "RWMS users scanned by a consumer",
+    ("stage",),
+    registry=REGISTRY,
+)
+RWMS_USERS = Gauge(
+    "user_notify_rwms_users",
+    "Users fetched from RWMS by the last successful fetch",
+    registry=REGISTRY,
+)
+TRAFFIC_SNAPSHOT_SIZE = Gauge(
+    "user_notify_traffic_snapshot_users",
+    "Users in the traffic progress snapshot",
+    registry=REGISTRY,
+)
+QUEUE_DEPTH = Gauge(
+    "user_notify_queue_depth",
+    "Last observed depth of a destination queue (LLEN or stream lag)",
+    ("queue",),
+    registry=REGISTRY,
+)
+QUEUE_THROTTLED = Gauge(
+    "user_notify_queue_throttled",
+    "1 while low-priority pushes to the queue are held back",
+    ("queue",),
+    registry=REGISTRY,
+)
+BACKPRESSURE_WAIT = Counter(
+    "user_notify_backpressure_wait_seconds_total",
+    "Time pushes spent waiting for rate limit tokens or a drained queue",
+    ("queue",),
+    registry=REGISTRY,
+)
+RSS_BYTES = Gauge(
+    "user_notify_rss_bytes", "Resident set size of the process", registry=REGISTRY
+)
+RSS_BYTES.set_function(current_rss_bytes)
+
+
+class MetricsServer:
+    """HTTP endpoint prometheus_client в отдельном потоке, отдает REGISTRY."""
+
+    def __init__(self, host: str, port: int, registry: CollectorRegistry = REGISTRY):
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__host = host
+        self.__port = port
+        self.__registry = registry
+        self.__server: Optional[WSGIServer] = None
+        self.__thread: Optional[Thread] = None
+
+    async def start(self) -> None:
+        self.__server, self.__thread = start_http_server(
+            self.__port, addr=self.__host, registry=self.__registry
+        )
+        self.__logger.info(
+            f"metrics endpoint at http://{self.__host}:{self.__port}/metrics"
+        )
+
+    async def stop(self) -> None:
+        if self.__server is not None:
+            # shutdown() ждет выхода из serve_forever, не блокируем event loop
+            await asyncio.to_thread(self.__server.shutdown)
+            self.__server.server_close()
+            self.__thread.join()
@@ -0,0 +1,47 @@
+import os
+from alembic import context
+from sqlalchemy import create_engine
+
+from config import MI_UN_POSTGRES_HOST
+from config import MI_UN_POSTGRES_PORT
+from config import MI_UN_POSTGRES_USER
+from config import MI_UN_POSTGRES_PASSWORD
+from config import MI_UN_POSTGRES_DB
+
+# Схемой users и остальных таблиц владеет основной сервис, здесь только то,
+# что нужно запросам user-notify (индексы и т.п.), поэтому своя таблица версий
+VERSION_TABLE = "user_notify_alembic_version"
+
+
+def get_url() -> str:
+    return (
+        f"postgresql+psycopg2://{os.getenv(MI_UN_POSTGRES_USER)}:{os.getenv(MI_UN_POSTGRES_PASSWORD)}"
+        f"@{os.getenv(MI_UN_POSTGRES_HOST)}:{os.getenv(MI_UN_POSTGRES_PORT)}/{os.getenv(MI_UN_POSTGRES_DB)}"
+    )
+
+
+def run_migrations_offline() -> None:
+    context.configure(
+        url=get_url(),
+        literal_binds=True,
+        version_table=VERSION_TABLE,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    engine = create_engine(get_url())
+
+    with engine.connect() as connection:
+        context.configure(connection=connection, version_table=VERSION_TABLE)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,33 @@
+"""partial index on users.expire_at for finder windows
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Все окна в finder'ах - диапазоны по expire_at (см. expire_at_predicates.py).
+# INCLUDE (id, telegram_id) дает index-only scan для кандидатов и анти-джойнов.
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_expire_at_not_null
+                ON users (expire_at)
+                INCLUDE (id, telegram_id)
+                WHERE expire_at IS NOT NULL
+            """)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_expire_at_not_null")
@@ -1,72 +1,101 @@
 import logging
 import inspect
+import numpy as np
 import proto.rwmanager_pb2 as proto
+from typing import Iterable
 from datetime import datetime, timedelta
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from common.models.db import User, NcUsersNotification
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from common.models.db import NcUsersNotification
+from users_snapshot import UsersSnapshot
+from notified_cache import NotifiedCache
+from compact_state import IdSet
+from metrics import USERS_SCANNED
 
 
 class NcUsersFinder:
     def __init__(self, session_maker: async_sessionmaker):
         self.__logger = logging.getLogger(self.__class__.__name__)
         self.__session_maker = session_maker
+        self.__notified_cache = NotifiedCache(NcUsersNotification, "nc_notified")
+        self.__notified = IdSet()
+        self.__result: set[int] = set()
 
-    async def __get_notified(self, session: AsyncSession) -> set[int]:
-        notified_users = await session.execute(
-            select(User.telegram_id).join(
-                NcUsersNotification, User.id == NcUsersNotification.user_id
-            )
+    # Инкрементальный режим: begin() -> scan(page) для каждой страницы -> finish()
+    async def begin(self) -> None:
+        self.__logger.info("searching not connected users...")
+
+        self.__result = set()
+
+        async with self.__session_maker() as session:
+            self.__notified = await self.__notified_cache.refresh(session=session)
+
+        self.__logger.info(
+            f"found {len(self.__notified)} not connected created yesterday users already notified"
         )
 
-        return set(row[0] for row in notified_users.fetchall())
+    def scan(self, users: Iterable[proto.UserResponse]) -> None:
+        now = datetime.now()
+        scanned = USERS_SCANNED.labels(stage="not connected users")
 
-    async def find(self, users: list[proto.UserResponse]) -> set[int]:
-        try:
-            self.__logger.info("searching not connected users...")
+        for user in users:
+            scanned.inc()
 
-            result = set()
+            if not user.HasField("created_at"):
+                continue
 
-            async with self.__session_maker() as session:
-                notified = await self.__get_notified(session=session)
+            created_at = user.created_at.ToDatetime()
 
-            self.__logger.info(
-                f"found {len(notified)} not connected created yesterday users already notified"
+            is_user_created_yesterday = (now.date() - created_at.date()) == timedelta(
+                days=1
             )
 
-            for user in users:
-                if not user.HasField("created_at"):
-                    continue
-
-                created_at = user.created_at.ToDatetime()
+            dont_handle_user = (
+                not is_user_created_yesterday or user.lifetime_used_traffic_bytes > 0
+            )
 
-                now = datetime.now()
-                is_user_created_yesterday = (
-                    now.date() - created_at.date()
-                ) == timedelta(days=1)
+            if dont_handle_user:
+                continue
 
-                dont_handle_user = (
-                    not is_user_created_yesterday
-                    or user.lifetime_used_traffic_bytes > 0
-                )
+            tg_id = int(user.username)
 
-                if dont_handle_user:
-                    continue
+            if tg_id in self.__notified:
+                continue
 
-                tg_id = int(user.username)
+            self.__logger.info(
+                f"user {user.username} created_at={created_at}, no traffic, will be notified"
+            )
+            self.__result.add(tg_id)
 
-                if tg_id in notified:
-                    continue
+    def scan_snapshot(self, snapshot: UsersSnapshot) -> None:
+        yesterday = datetime.now().date() - timedelta(days=1)
+        USERS_SCANNED.labels(stage="not connected users").inc(len(snapshot))
 
-                self.__logger.info(
-                    f"user {user.username} created_at={created_at}, no traffic, will be notified"
-                )
-                result.add(tg_id)
+        candidates = np.array(
+            snapshot.created_on_without_traffic(yesterday), dtype=np.int64
+        )
 
+        for tg_id in candidates[~self.__notified.contains(candidates)].tolist():
             self.__logger.info(
-                f"{len(result)} users require 'not connected yesterday' notifications"
+                f"user {tg_id} created_at={yesterday}, no traffic, will be notified"
             )
-            return result
+            self.__result.add(tg_id)
+
+    def finish(self) -> set[int]:
+        result = self.__result
+
+        self.__notified = IdSet()
+        self.__result = set()
+
+        self.__logger.info(
+            f"{len(result)} users require 'not connected yesterday' notifications"
+        )
+        return result
+
+    async def find(self, users: list[proto.UserResponse]) -> set[int]:
+        try:
+            await self.begin()
+            self.scan(users)
+            return self.finish()
         except Exception:
             self.__logger.exception(f"error in {inspect.currentframe().f_code.co_name}")
             return set()
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from sqlalchemy import Text
+from sqlalchemy import Table
+from sqlalchemy import Column
+from sqlalchemy import BigInteger
+from sqlalchemy import DateTime
+from sqlalchemy import MetaData
+from sqlalchemy import Identity
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import insert
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from metrics import DB_STATEMENT_DURATION
+from redis_publisher import RedisPublisher
+
+KOUTBOX_INSERT_BATCH = 5000
+
+# Таблица принадлежит user-notify (миграция 0002), поэтому описана здесь, а не в common
+OUTBOX_TABLE = Table(
+    "user_notify_outbox",
+    MetaData(),
+    Column("id", BigInteger, Identity(), primary_key=True),
+    Column("queue", Text, nullable=False),
+    Column("payload", Text, nullable=False),
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    ),
+)
+
+
+# Строки одного сообщения в разных очередях (копии для vpn и vps ботов) собираются
+# обратно: (очереди) -> [(payload, {очередь: id строки})]. Каждая группа пушится
+# одним push_payloads на все свои очереди, так что с MI_UN_REDIS_FANOUT копии
+# попадают в очереди атомарно, как и без outbox.
+def group_copies(
+    rows: list[tuple[int, str, str]],
+) -> dict[tuple[str, ...], list[tuple[str, dict[str, int]]]]:
+    messages: dict[str, list[dict[str, int]]] = {}
+
+    for row_id, queue, payload in rows:
+        copies = messages.setdefault(payload, [])
+
+        # одинаковый payload может прийти несколько раз (например, из разных циклов)
+        for copy in copies:
+            if queue not in copy:
+                copy[queue] = row_id
+                break
+        else:
+            copies.append({queue: row_id})
+
+    groups: dict[tuple[str, ...], list[tuple[str, dict[str, int]]]] = {}
+
+    for payload, copies in messages.items():
+        for copy in copies:
+            groups.setdefault(tuple(sorted(copy)), []).append((payload, copy))
+
+    return groups
+
+
+class NotificationOutbox:
+    """
+    Сериализованные сообщения пишутся в outbox в той же транзакции, что и
+    состояние finder'а, одна строка на (очередь, сообщение). В Redis их
+    переносит OutboxDrainer.
+    """
+
+    async def add(
+        self, session: AsyncSession, payloads: list[bytes], queues: list[str]
+    ) -> int:
+        rows = []
+
+        for payload in payloads:
+            text = payload.decode("utf-8")
+            rows.extend({"queue": queue, "payload": text} for queue in queues)
+
+        for start in range(0, len(rows), KOUTBOX_INSERT_BATCH):
+            with DB_STATEMENT_DURATION.labels(group="outbox_insert").time():
+                await session.execute(
+                    insert(OUTBOX_TABLE), rows[start : start + KOUTBOX_INSERT_BATCH]
+                )
+
+        return len(rows)
+
+
+class OutboxDrainer:
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        publisher: RedisPublisher,
+        batch_size: int = 5000,
+        poll_interval: float = 1.0,
+    ):
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__session_maker = session_maker
+        self.__publisher = publisher
+        self.__batch_size = batch_size
+        self.__poll_interval = poll_interval
+
+    # Забирает одну пачку строк, пушит их в Redis и удаляет доставленные.
+    # Строки, которые не удалось запушить, остаются и будут взяты снова.
+    async def drain_once(self) -> int:
+        async with self.__session_maker() as session:
+            async with session.begin():
+                with DB_STATEMENT_DURATION.labels(group="outbox_claim").time():
+                    claimed = await session.execute(
+                        select(
+                            OUTBOX_TABLE.c.id,
+                            OUTBOX_TABLE.c.queue,
+                            OUTBOX_TABLE.c.payload,
+                        )
+                        .order_by(OUTBOX_TABLE.c.id)
+                        .limit(self.__batch_size)
+                        .with_for_update(skip_locked=True)
+                    )
+
+                rows = claimed.tuples().all()
+
+                if not rows:
+                    return 0
+
+                delivered: list[int] = []
+                pushed: dict[str, int] = {}
+
+                for queues, group in group_copies(rows).items():
+                    # без ожидания backpressure: строки заблокированы до коммита
+                    result = await self.__publisher.push_payloads(
+                        [payload for payload, _ in group], list(queues), admit=False
+                    )
+                    failed = {
+                        (failure.index, failure.queue) for failure in result.failed
+                    }
+
+                    for queue, count in result.pushed.items():
+                        pushed[queue] = pushed.get(queue, 0) + count
+
+                    delivered.extend(
+                        row_id
+                        for index, (_, copy) in enumerate(group)
+                        for queue, row_id in copy.items()
+                        if (index, queue) not in failed
+                    )
+
+                with DB_STATEMENT_DURATION.labels(group="outbox_delete").time():
+                    await session.execute(
+                        delete(OUTBOX_TABLE).where(OUTBOX_TABLE.c.id.in_(delivered))
+                    )
+
+        # rate limit и глубина очередей - уже после коммита, когда блокировки сняты
+        await self.__settle(pushed)
+
+        if len(delivered) < len(rows):
+            self.__logger.error(
+                f"delivered {len(delivered)} of {len(rows)} outbox messages"
+            )
+
+        return len(delivered)
+
+    async def __settle(self, pushed: dict[str, int]) -> None:
+        backpressure = self.__publisher.backpressure
+
+        if backpressure is None:
+            return
+
+        try:
+            await backpressure.settle(pushed)
+        except Exception as e:
+            self.__logger.error(f"failed to check queues depth: {e}")
+
+    async def drain(self) -> int:
+        total = 0
+
+        while drained := await self.drain_once():
+            total += drained
+
+        return total
+
+    async def run(self) -> None:
+        while True:
+            try:
+                drained = await self.drain_once()
+            except Exception:
+                self.__logger.exception("outbox drain error")
+                drained = 0
+
+            if drained:
+                self.__logger.debug(f"drained {drained} outbox messages")
+
+            # полная пачка - скорее всего есть еще, продолжаем без паузы
+            if drained < self.__batch_size:
+                await asyncio.sleep(self.__poll_interval)
@@ -0,0 +1,95 @@
+import logging
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from common.models.db import User
+from compact_state import IdSet
+from metrics import DB_STATEMENT_DURATION
+
+# строки с id чуть ниже watermark перечитываются: транзакции писателей
+# (ботов) могут закоммитить меньший id позже большего
+KWATERMARK_OVERLAP = 1000
+# полная перезагрузка раз в столько refresh(): подбирает то, что пропустила
+# сверка числа строк (удаление и поздняя вставка между двумя refresh())
+KFULL_RELOAD_EVERY = 100
+
+
+class NotifiedCache:
+    """
+    telegram_id пользователей, у которых есть строка в таблице уведомлений
+    model (user_id -> users.id). Первый refresh() читает таблицу целиком,
+    следующие - только строки с id > watermark - KWATERMARK_OVERLAP и число
+    строк в таблице. Если оно не сходится с прочитанным (строки удалены,
+    например очисткой истекших, или закоммичены ниже overlap), таблица
+    перечитывается целиком в том же refresh().
+    """
+
+    def __init__(self, model, metric_group: str):
+        self.__logger = logging.getLogger(
+            f"{self.__class__.__name__}.{model.__tablename__}"
+        )
+        self.__model = model
+        self.__metric_group = metric_group
+        self.__watermark = 0
+        self.__refreshes = 0
+        self.__row_count = 0
+        self.telegram_ids = IdSet()
+
+    async def refresh(self, session: AsyncSession) -> IdSet:
+        full = self.__refreshes % KFULL_RELOAD_EVERY == 0
+
+        query = select(self.__model.id, User.telegram_id).join(
+            User, User.id == self.__model.user_id
+        )
+
+        if not full:
+            count_query = (
+                select(func.count())
+                .select_from(self.__model)
+                .join(User, User.id == self.__model.user_id)
+            )
+            incremental_query = query.where(
+                self.__model.id > self.__watermark - KWATERMARK_OVERLAP
+            )
+
+            with DB_STATEMENT_DURATION.labels(group=self.__metric_group).time():
+                total = await session.scalar(count_query)
+                rows = (await session.execute(incremental_query)).tuples().all()
+
+            # строки выше watermark новые, остальные из overlap уже учтены
+            new_rows = sum(1 for row_id, _ in rows if row_id > self.__watermark)
+
+            if total != self.__row_count + new_rows:
+                self.__logger.info(
+                    f"{total} rows in table, {self.__row_count + new_rows} "
+                    f"expected, reloading"
+                )
+                full = True
+            else:
+                self.__row_count = total
+
+        if full:
+            with DB_STATEMENT_DURATION.labels(group=self.__metric_group).time():
+                rows = (await session.execute(query)).tuples().all()
+
+            self.__row_count = len(rows)
+
+        # считаем только успешные чтения: упавшая первая загрузка повторится целиком
+        self.__refreshes += 1
+
+        if rows:
+            row_ids, tg_ids = zip(*rows)
+            self.__watermark = max(self.__watermark, max(row_ids))
+        else:
+            tg_ids = ()
+
+        if full:
+            self.telegram_ids = IdSet(tg_ids)
+        else:
+            self.telegram_ids.update(tg_ids)
+
+        self.__logger.debug(
+            f"{'reloaded' if full else 'refreshed'} with {len(rows)} rows, "
+            f"{len(self.telegram_ids)} notified, watermark {self.__watermark}"
+        )
+
+        return self.telegram_ids
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import logging
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from metrics import QUEUE_DEPTH, QUEUE_THROTTLED, BACKPRESSURE_WAIT
+
+KHIGH_PRIORITY = "high"
+KLOW_PRIORITY = "low"
+
+
+class TokenBucket:
+    """
+    rate сообщений в секунду, burst - сколько можно отправить сразу после простоя.
+    Чанк больше остатка берется в долг: reserve() возвращает, сколько ждать,
+    пока долг не вернется.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__updated = time.monotonic()
+
+    def reserve(self, count: int) -> float:
+        now = time.monotonic()
+        self.__tokens = min(
+            self.burst, self.__tokens + (now - self.__updated) * self.rate
+        )
+        self.__updated = now
+        self.__tokens -= count
+
+        return max(0.0, -self.__tokens / self.rate)
+
+
+class QueueBackpressure:
+    """
+    Перед каждым чанком публикации смотрит глубину очередей назначения
+    (LLEN для list, lag групп потребителей или XLEN для stream). Очередь выше
+    high_water помечается throttled и остается такой, пока не опустится до
+    low_water; все это время low-priority пуши в нее ждут. Все пуши, кроме
+    того, ограничены token bucket'ом на очередь (rate_limit = 0 - без лимита).
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        stream_backend: bool,
+        high_water: int,
+        low_water: int,
+        rate_limit: float,
+        poll_interval: float,
+    ):
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__redis = redis
+        self.__stream_backend = stream_backend
+        self.__high_water = high_water
+        self.__low_water = low_water
+        self.__rate_limit = rate_limit
+        self.__poll_interval = poll_interval
+        self.__buckets: dict[str, TokenBucket] = {}
+        self.__depths: dict[str, int] = {}
+        self.__throttled: dict[str, bool] = {}
+
+        self.__logger.info(
+            f"backpressure: high water {high_water}, low water {low_water}, "
+            f"rate limit {rate_limit or 'off'} msg/s per queue"
+        )
+
+    # queue -> последняя глубина и throttled, то же, что в метриках
+    def state(self) -> dict[str, dict]:
+        return {
+            queue: {"depth": depth, "throttled": self.__throttled[queue]}
+            for queue, depth in self.__depths.items()
+        }
+
+    async def admit(self, queues: list[str], count: int, priority: str) -> None:
+        await self.refresh(queues)
+
+        if priority == KLOW_PRIORITY:
+            while held := [queue for queue in queues if self.__throttled[queue]]:
+                self.__logger.debug(f"holding back {count} messages for {held}")
+                await self.__wait(held, self.__poll_interval)
+                await self.refresh(queues)
+
+        await self.__limit({queue: count for queue in queues})
+
+    # Для пушей, которые нельзя задерживать до отправки (outbox держит блокировки
+    # строк, пока публикует): токены списываются по факту отправки, а ожидание
+    # ложится перед следующей пачкой. pushed - queue -> сколько отправлено
+    async def settle(self, pushed: dict[str, int]) -> None:
+        await self.refresh(list(pushed))
+        await self.__limit(pushed)
+
+    async def __limit(self, counts: dict[str, int]) -> None:
+        if self.__rate_limit <= 0 or not counts:
+            return
+
+        delays = {
+            queue: self.__bucket(queue).reserve(count)
+            for queue, count in counts.items()
+        }
+        delay = max(delays.values())
+
+        if delay > 0:
+            await self.__wait([q for q, d in delays.items() if d > 0], delay)
+
+    async def refresh(self, queues: list[str]) -> None:
+        for queue in queues:
+            depth = await self.__depth(queue)
+            throttled = self.__throttled.get(queue, False)
+
+            if not throttled and depth >= self.__high_water:
+                throttled = True
+                self.__logger.warning(
+                    f"{queue} depth {depth} reached high water mark, "
+                    f"holding back low-priority messages"
+                )
+            elif throttled and depth <= self.__low_water:
+                throttled = False
+                self.__logger.info(
+                    f"{queue} depth {depth} is below low water mark, resuming"
+                )
+
+            self.__depths[queue] = depth
+            self.__throttled[queue] = throttled
+            QUEUE_DEPTH.labels(queue=queue).set(depth)
+            QUEUE_THROTTLED.labels(queue=queue).set(1 if throttled else 0)
+
+    async def __depth(self, queue: str) -> int:
+        if not self.__stream_backend:
+            return await self.__redis.llen(queue)
+
+        # у группы потребителей lag - непрочитанные ею записи; он неизвестен
+        # (None), если часть записей удалена, тогда берется длина стрима
+        try:
+            groups = await self.__redis.xinfo_groups(queue)
+        except ResponseError:
+            return 0  # стрима еще нет
+
+        lags = [group.get("lag") for group in groups]
+
+        if lags and None not in lags:
+            return max(lags)
+
+        return await self.__redis.xlen(queue)
+
+    def __bucket(self, queue: str) -> TokenBucket:
+        if queue not in self.__buckets:
+            self.__buckets[queue] = TokenBucket(
+                self.__rate_limit, max(self.__rate_limit, 1)
+            )
+
+        return self.__buckets[queue]
+
+    async def __wait(self, queues: list[str], seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+        for queue in queues:
+            BACKPRESSURE_WAIT.labels(queue=queue).inc(seconds)
@@ -1,50 +1,273 @@
 import orjson
 import logging
+from typing import Optional
+from typing import Union
+from pydantic import BaseModel
 from redis.asyncio import Redis
 from config import Config
 from common.models.messages import MessageUnion
+from queue_backpressure import KHIGH_PRIORITY
+from queue_backpressure import QueueBackpressure
+from metrics import MESSAGES_FAILED, MESSAGES_PUBLISHED, REDIS_PUSH_DURATION
+
+VPN_BOT_QUEUE = "monkey-island-vpn-bot"
+VPS_BOT_QUEUE = "monkey-island-vps-bot"
+YM_STAT_QUEUE = "monkey-island-ym-stat"
+
+BOT_QUEUES = [VPN_BOT_QUEUE, VPS_BOT_QUEUE]
+
+KLIST_BACKEND = "list"
+KSTREAM_BACKEND = "stream"
+KSTREAM_FIELD = "data"
+
+# unpack() в Lua ограничен стеком (LUAI_MAXCSTACK = 8000), RPUSH идет кусками
+KLUA_UNPACK_STEP = 4000
+
+# Скрипты fan-out: KEYS - очереди, ARGV - сообщения пачки. Тип всех ключей
+# проверяется до первой записи, поэтому пачка попадает либо во все очереди,
+# либо ни в одну. Все очереди должны быть в одном слоте (Redis без кластера).
+LIST_FANOUT_SCRIPT = f"""
+for _, key in ipairs(KEYS) do
+    local kind = redis.call('TYPE', key).ok
+    if kind ~= 'none' and kind ~= 'list' then
+        return redis.error_reply('WRONGTYPE ' .. key .. ' holds ' .. kind)
+    end
+end
+for _, key in ipairs(KEYS) do
+    for i = 1, #ARGV, {KLUA_UNPACK_STEP} do
+        local last = math.min(i + {KLUA_UNPACK_STEP - 1}, #ARGV)
+        redis.call('RPUSH', key, unpack(ARGV, i, last))
+    end
+end
+return #ARGV
+"""
+
+# ARGV[1] - MAXLEN, ARGV[2] - имя поля, дальше сообщения
+STREAM_FANOUT_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    local kind = redis.call('TYPE', key).ok
+    if kind ~= 'none' and kind ~= 'stream' then
+        return redis.error_reply('WRONGTYPE ' .. key .. ' holds ' .. kind)
+    end
+end
+for _, key in ipairs(KEYS) do
+    for i = 3, #ARGV do
+        redis.call('XADD', key, 'MAXLEN', '~', ARGV[1], '*', ARGV[2], ARGV[i])
+    end
+end
+return #ARGV - 2
+"""
+
+# bytes - из serialize_message и шаблонов, str - из outbox
+Payload = Union[bytes, str]
+
+
+# Redis принимает bytes как есть, обратно в str сообщение не переводится
+def serialize_message(message: MessageUnion) -> bytes:
+    return orjson.dumps(message.model_dump())
+
+
+class PushFailure(BaseModel):
+    index: int  # index of the message in the pushed batch
+    queue: str
+    error: str
+
+
+class PushBatchResult(BaseModel):
+    pushed: dict[str, int] = {}  # queue -> number of pushed messages
+    failed: list[PushFailure] = []
 
 
 class RedisPublisher:
-    def __init__(self, config: Config):
+    # redis передается снаружи только в бенчмарках и тестовых стендах
+    def __init__(self, config: Config, redis: Optional[Redis] = None):
         self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__batch_size = config.redis_batch_size
+        self.__backend = config.redis_backend
+        self.__stream_maxlen = config.redis_stream_maxlen
+        self.__use_fanout = config.redis_fanout
+
+        if self.__backend not in (KLIST_BACKEND, KSTREAM_BACKEND):
+            raise ValueError(f"unknown Redis backend '{self.__backend}'")
 
-        self.__redis = Redis(
-            host=config.redis_host,
-            port=config.redis_port,
-            password=config.redis_password,
-            decode_responses=True,
+        if redis is not None:
+            self.__redis = redis
+        else:
+            self.__redis = Redis(
+                host=config.redis_host,
+                port=config.redis_port,
+                password=config.redis_password,
+                decode_responses=True,
+            )
+            self.__logger.info(
+                f"connected to Redis at {config.redis_host}:{config.redis_port} "
+                f"({self.__backend} backend, fan-out {self.__use_fanout})"
+            )
+
+        # Script вызывает EVALSHA и загружает скрипт сам, если Redis ответил NOSCRIPT
+        self.__fanout_script = self.__redis.register_script(
+            STREAM_FANOUT_SCRIPT
+            if self.__backend == KSTREAM_BACKEND
+            else LIST_FANOUT_SCRIPT
         )
-        self.__logger.info(
-            f"connected to Redis at {config.redis_host}:{config.redis_port}"
+
+        self.backpressure: Optional[QueueBackpressure] = None
+
+        if config.redis_backpressure:
+            self.backpressure = QueueBackpressure(
+                redis=self.__redis,
+                stream_backend=self.__backend == KSTREAM_BACKEND,
+                high_water=config.redis_high_water,
+                low_water=config.redis_low_water,
+                rate_limit=config.redis_rate_limit,
+                poll_interval=config.redis_backpressure_poll,
+            )
+
+    # Загружает скрипт fan-out заранее, чтобы первая пачка не ловила NOSCRIPT
+    async def load_scripts(self) -> None:
+        await self.__redis.script_load(self.__fanout_script.script)
+
+    # list: RPUSH, stream: XADD с приблизительной обрезкой до MAXLEN ~ stream_maxlen
+    # Ставит команды в pipeline, возвращает число поставленных команд
+    def __append(self, pipe, queue: str, payloads: list[Payload]) -> int:
+        if self.__backend == KSTREAM_BACKEND:
+            for payload in payloads:
+                pipe.xadd(
+                    queue,
+                    {KSTREAM_FIELD: payload},
+                    maxlen=self.__stream_maxlen,
+                    approximate=True,
+                )
+
+            return len(payloads)
+
+        pipe.rpush(queue, *payloads)
+        return 1
+
+    # Уже сериализованные сообщения (шаблоны, outbox), индексы в failed - по payloads.
+    # admit=False - без ожидания backpressure, вызывающий сам делает settle()
+    async def push_payloads(
+        self,
+        payloads: list[Payload],
+        queues: list[str],
+        priority: str = KHIGH_PRIORITY,
+        admit: bool = True,
+    ) -> PushBatchResult:
+        result = PushBatchResult(pushed={queue: 0 for queue in queues})
+        await self.__push_payloads(
+            payloads, list(range(len(payloads))), queues, result, priority, admit=admit
         )
+        return result
+
+    async def __push_payloads(
+        self,
+        payloads: list[Payload],
+        indexes: list[int],
+        queues: list[str],
+        result: PushBatchResult,
+        priority: str,
+        admit: bool = True,
+    ) -> None:
+        push_chunk = (
+            self.__fan_out_chunk if self.__use_fanout else self.__pipeline_chunk
+        )
+
+        for start in range(0, len(payloads), self.__batch_size):
+            chunk = payloads[start : start + self.__batch_size]
+
+            if admit and self.backpressure is not None:
+                try:
+                    await self.backpressure.admit(queues, len(chunk), priority)
+                except Exception as e:
+                    # без глубины очередей пушим как обычно, ошибку Redis увидит push
+                    self.__logger.error(f"failed to check queues depth: {e}")
+
+            await push_chunk(
+                chunk, indexes[start : start + self.__batch_size], queues, result
+            )
+
+        for queue in queues:
+            MESSAGES_PUBLISHED.labels(queue=queue).inc(result.pushed[queue])
+
+        for failure in result.failed:
+            MESSAGES_FAILED.labels(queue=failure.queue).inc()
+
+    # Один вызов скрипта на чанк: он целиком либо во всех очередях, либо ни в одной
+    async def __fan_out_chunk(
+        self,
+        chunk: list[Payload],
+        chunk_indexes: list[int],
+        queues: list[str],
+        result: PushBatchResult,
+    ) -> None:
+        if self.__backend == KSTREAM_BACKEND:
+            args = [self.__stream_maxlen, KSTREAM_FIELD, *chunk]
+        else:
+            args = chunk
 
-    async def push_message_to_vpn_bot(self, message: MessageUnion):
-        try:
-            data = message.model_dump()
-            json = orjson.dumps(data).decode("utf-8")
-            await self.__redis.rpush("monkey-island-vpn-bot", json)
-            self.__logger.debug(f"message pushed: {data}")
-        except Exception:
-            self.__logger.exception("failed to push message to Redis")
-            raise
-
-    async def push_message_to_vps_bot(self, message: MessageUnion):
         try:
-            data = message.model_dump()
-            json = orjson.dumps(data).decode("utf-8")
-            await self.__redis.rpush("monkey-island-vps-bot", json)
-            self.__logger.debug(f"message pushed: {data}")
-        except Exception:
-            self.__logger.exception("failed to push message to Redis")
-            raise
-
-    async def push_message_to_ym_stat(self, message: MessageUnion):
+            with REDIS_PUSH_DURATION.time():
+                await self.__fanout_script(keys=queues, args=args)
+        except Exception as e:
+            self.__logger.error(
+                f"failed to fan out {len(chunk)} messages to {queues}: {e}"
+            )
+            result.failed.extend(
+                PushFailure(index=index, queue=queue, error=str(e))
+                for queue in queues
+                for index in chunk_indexes
+            )
+            return
+
+        for queue in queues:
+            result.pushed[queue] += len(chunk)
+
+    # Один pipeline на чанк: RPUSH на очередь (list) или XADD на сообщение (stream),
+    # очереди могут разойтись, если команда для одной из них упала
+    async def __pipeline_chunk(
+        self,
+        chunk: list[Payload],
+        chunk_indexes: list[int],
+        queues: list[str],
+        result: PushBatchResult,
+    ) -> None:
+        commands: list[int] = []
+
         try:
-            data = message.model_dump()
-            json = orjson.dumps(data).decode("utf-8")
-            await self.__redis.rpush("monkey-island-ym-stat", json)
-            self.__logger.debug(f"message pushed: {data}")
-        except Exception:
-            self.__logger.exception("failed to push message to Redis")
-            raise
+            with REDIS_PUSH_DURATION.time():
+                async with self.__redis.pipeline(transaction=False) as pipe:
+                    for queue in queues:
+                        commands.append(self.__append(pipe, queue, chunk))
+
+                    replies = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            commands = [1] * len(queues)
+            replies = [e] * len(queues)
+
+        position = 0
+
+        for queue, count in zip(queues, commands):
+            queue_replies = replies[position : position + count]
+            position += count
+
+            # у RPUSH один ответ на весь чанк, у XADD - на каждое сообщение
+            if count != len(chunk):
+                queue_replies = queue_replies * len(chunk)
+
+            errors = [
+                (index, reply)
+                for index, reply in zip(chunk_indexes, queue_replies)
+                if isinstance(reply, Exception)
+            ]
+
+            if errors:
+                self.__logger.error(
+                    f"failed to push {len(errors)} of {len(chunk)} messages "
+                    f"to {queue}: {errors[0][1]}"
+                )
+                result.failed.extend(
+                    PushFailure(index=index, queue=queue, error=str(reply))
+                    for index, reply in errors
+                )
+
+            result.pushed[queue] += len(chunk) - len(errors)
@@ -0,0 +1,57 @@
+import grpc
+import asyncio
+import logging
+import multiprocessing
+import proto.rwmanager_pb2 as proto
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor
+from users_snapshot import UsersColumns, users_columns
+
+GET_ALL_USERS_METHOD = "/rwmanager.RwManager/GetAllUsers"
+
+
+class DecodedUsersPage(NamedTuple):
+    total: float
+    columns: UsersColumns
+
+
+# Выполняется в процессе пула: в event loop возвращаются только колонки
+def decode_users_page(data: bytes) -> DecodedUsersPage:
+    reply = proto.GetAllUsersReply.FromString(data)
+    return DecodedUsersPage(total=reply.total, columns=users_columns(reply.users))
+
+
+class RwmsPagesDecoder:
+    """
+    Замена RwmsClient для RwmsUsersFetcher: GetAllUsers вызывается без
+    десериализатора, сырые байты страницы разбираются в ProcessPoolExecutor.
+    Ответ - DecodedUsersPage, у которого, как у GetAllUsersReply, есть total.
+    """
+
+    def __init__(self, addr: str, port: int, workers: int):
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__channel = grpc.aio.insecure_channel(f"{addr}:{port}")
+        self.__get_all_users = self.__channel.unary_unary(
+            GET_ALL_USERS_METHOD,
+            request_serializer=proto.GetAllUsersRequest.SerializeToString,
+            response_deserializer=None,
+        )
+
+        # spawn, а не fork: fork процесса с уже запущенными потоками grpc небезопасен
+        self.__executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.__logger.info(f"decoding RWMS pages in {workers} processes")
+
+    async def get_all_users(self, offset: int, count: int) -> DecodedUsersPage:
+        data = await self.__get_all_users(
+            proto.GetAllUsersRequest(offset=offset, count=count)
+        )
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, decode_users_page, data
+        )
+
+    async def close(self) -> None:
+        await self.__channel.close()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
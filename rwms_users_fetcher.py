@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator
+from typing import Optional
+import proto.rwmanager_pb2 as proto
+from common.rwms_client import RwmsClient
+from metrics import RWMS_PAGE_DURATION, RWMS_PAGE_ERRORS
+
+
+class RwmsUsersFetcher:
+    def __init__(
+        self,
+        rwms: RwmsClient,
+        page_size: int = 1000,
+        max_in_flight: int = 8,
+        page_retries: int = 3,
+    ):
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__rwms = rwms
+        self.__page_size = page_size
+        self.__max_in_flight = max_in_flight
+        self.__page_retries = page_retries
+
+    async def __get_page(self, offset: int) -> proto.GetAllUsersReply:
+        try:
+            with RWMS_PAGE_DURATION.time():
+                return await self.__rwms.get_all_users(
+                    offset=offset, count=self.__page_size
+                )
+        except Exception:
+            RWMS_PAGE_ERRORS.inc()
+            raise
+
+    async def __fetch_page(
+        self, semaphore: asyncio.Semaphore, offset: int
+    ) -> proto.GetAllUsersReply:
+        async with semaphore:
+            return await self.__get_page(offset)
+
+    async def fetch_all(self) -> list[proto.UserResponse]:
+        # Первая страница нужна, чтобы узнать total, остальные запрашиваем параллельно
+        first = await self.__await_page(0)
+        total = int(first.total)
+
+        pages: dict[int, list[proto.UserResponse]] = {0: list(first.users)}
+        pending = list(range(self.__page_size, total, self.__page_size))
+        semaphore = asyncio.Semaphore(self.__max_in_flight)
+
+        self.__logger.debug(
+            f"fetching {total} users in {len(pending) + 1} pages "
+            f"({self.__max_in_flight} in flight)"
+        )
+
+        for attempt in range(self.__page_retries + 1):
+            if not pending:
+                break
+
+            if attempt > 0:
+                self.__logger.warning(
+                    f"retrying {len(pending)} failed pages (attempt {attempt})"
+                )
+                await asyncio.sleep(attempt)
+
+            replies = await asyncio.gather(
+                *(self.__fetch_page(semaphore, offset) for offset in pending),
+                return_exceptions=True,
+            )
+
+            failed = []
+
+            for offset, reply in zip(pending, replies):
+                if isinstance(reply, Exception):
+                    self.__logger.error(
+                        f"failed to fetch page at offset {offset}: {reply}"
+                    )
+                    failed.append(offset)
+                elif isinstance(reply, BaseException):
+                    raise reply
+                else:
+                    pages[offset] = list(reply.users)
+
+            pending = failed
+
+        if pending:
+            raise RuntimeError(
+                f"failed to fetch {len(pending)} pages after {self.__page_retries} retries"
+            )
+
+        result: list[proto.UserResponse] = []
+
+        for offset in sorted(pages):
+            result.extend(pages[offset])
+
+        return result
+
+    # Страница с повторами; task - уже запущенный первый запрос, если есть
+    async def __await_page(
+        self, offset: int, task: Optional[asyncio.Task] = None
+    ) -> proto.GetAllUsersReply:
+        try:
+            return await (task if task is not None else self.__get_page(offset))
+        except Exception as e:
+            self.__logger.error(f"failed to fetch page at offset {offset}: {e}")
+
+        for attempt in range(1, self.__page_retries + 1):
+            await asyncio.sleep(attempt)
+
+            try:
+                return await self.__get_page(offset)
+            except Exception as e:
+                self.__logger.error(
+                    f"failed to fetch page at offset {offset} (attempt {attempt}): {e}"
+                )
+
+        raise RuntimeError(
+            f"failed to fetch page at offset {offset} after {self.__page_retries} retries"
+        )
+
+    # Отдает ответы по порядку, держа в памяти не больше max_in_flight страниц
+    async def iter_replies(self) -> AsyncIterator[proto.GetAllUsersReply]:
+        first = await self.__await_page(0)
+        offsets = deque(range(self.__page_size, int(first.total), self.__page_size))
+        in_flight: deque[tuple[int, asyncio.Task]] = deque()
+
+        def schedule() -> None:
+            while offsets and len(in_flight) < self.__max_in_flight:
+                offset = offsets.popleft()
+                task = asyncio.create_task(self.__get_page(offset))
+                in_flight.append((offset, task))
+
+        try:
+            schedule()
+            yield first
+            del first
+
+            while in_flight:
+                offset, task = in_flight.popleft()
+                reply = await self.__await_page(offset, task)
+                schedule()
+                yield reply
+                del reply
+        finally:
+            for _, task in in_flight:
+                task.cancel()
+
+    async def iter_pages(self) -> AsyncIterator[list[proto.UserResponse]]:
+        async for reply in self.iter_replies():
+            page = list(reply.users)
+            del reply
+            yield page
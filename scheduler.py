@@ -0,0 +1,85 @@
+import time
+import random
+import asyncio
+import logging
+from typing import Callable, Awaitable, Optional
+
+
+class ScheduledJob:
+    def __init__(
+        self,
+        name: str,
+        interval: float,
+        jitter: float,
+        job: Callable[[], Awaitable[None]],
+    ):
+        self.name = name
+        self.interval = interval
+        self.jitter = jitter
+        self.job = job
+        self.task: Optional[asyncio.Task] = None
+        self.skipped = 0
+        self.next_run: Optional[float] = None  # time.monotonic() следующего тика
+
+
+class Scheduler:
+    """
+    Каждая задача запускается со своим интервалом (секунды) плюс случайный jitter.
+    Если к очередному тику предыдущий запуск еще не закончился, тик пропускается:
+    одна и та же задача никогда не выполняется параллельно сама с собой.
+    """
+
+    def __init__(self):
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__jobs: list[ScheduledJob] = []
+
+    def register(
+        self,
+        name: str,
+        interval: float,
+        job: Callable[[], Awaitable[None]],
+        jitter: float = 0,
+    ) -> None:
+        self.__jobs.append(ScheduledJob(name, interval, jitter, job))
+        self.__logger.info(
+            f"registered job '{name}' every {interval:.0f}s (jitter {jitter:.0f}s)"
+        )
+
+    # Через сколько секунд задача name запустится, или None, если следующий тик
+    # не запустит ее (не зарегистрирована, еще не спланирована или все еще выполняется)
+    def due_in(self, name: str) -> Optional[float]:
+        for job in self.__jobs:
+            if job.name != name or job.next_run is None:
+                continue
+
+            if job.task is not None and not job.task.done():
+                return None
+
+            return max(0.0, job.next_run - time.monotonic())
+
+        return None
+
+    async def run(self) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for job in self.__jobs:
+                tg.create_task(self.__tick_loop(job))
+
+    async def __tick_loop(self, job: ScheduledJob) -> None:
+        try:
+            while True:
+                tick = time.monotonic()
+
+                if job.task is not None and not job.task.done():
+                    job.skipped += 1
+                    self.__logger.warning(
+                        f"job '{job.name}' is still running, skipping tick ({job.skipped} skipped)"
+                    )
+                else:
+                    job.task = asyncio.create_task(job.job(), name=job.name)
+
+                delay = job.interval + random.uniform(0, job.jitter)
+                job.next_run = tick + delay
+                await asyncio.sleep(max(0.0, job.next_run - time.monotonic()))
+        finally:
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
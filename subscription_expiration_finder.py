@@ -1,10 +1,18 @@
 import logging
 from pydantic import BaseModel
 from typing import Set
-from sqlalchemy import func, text, select, delete
+from typing import Callable, Awaitable, Optional
+from datetime import timedelta
+from sqlalchemy import select, delete
+from sqlalchemy import and_, or_, case, exists, literal
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from common.models.db import User, ExtendSubscriptionNotification, YkRecurrentPayment
+from expire_at_predicates import expire_at_after, expire_at_between
+from metrics import DB_STATEMENT_DURATION
+
+KONE_DAY_LEFT = 1
+KTHREE_DAYS_LEFT = 3
 
 
 class NotifyAboutSubscriptionExpiration(BaseModel):
@@ -17,103 +25,103 @@ class SubscriptionExpirationFinder:
         self.__logger = logging.getLogger(self.__class__.__name__)
         self.__session_maker = session_maker
 
-    async def find(self) -> NotifyAboutSubscriptionExpiration:
+    # on_found вызывается в транзакции поиска (например, чтобы записать outbox)
+    async def find(
+        self,
+        on_found: Optional[
+            Callable[
+                [AsyncSession, "NotifyAboutSubscriptionExpiration"], Awaitable[None]
+            ]
+        ] = None,
+    ) -> NotifyAboutSubscriptionExpiration:
         self.__logger.info("starting search for users with expiring subscriptions")
 
-        ESN = ExtendSubscriptionNotification
-
         async with self.__session_maker() as session:
             async with session.begin():
                 await self.__clear_extend_subscription_notifications_table(
                     session=session
                 )
-                users_1day_left = await self.__get_1day_left_users(session)
-                self.__logger.info(
-                    f"found {len(users_1day_left)} users with 1 day left"
-                )
 
-                users_3days_left = await self.__get_3days_left_users(session)
-                self.__logger.info(
-                    f"found {len(users_3days_left)} users with 3 days left"
-                )
+                result = NotifyAboutSubscriptionExpiration()
 
-                users_with_recurrent = await self.__get_tg_ids_with_recurrent(session)
-                self.__logger.info(
-                    f"found {len(users_with_recurrent)} users with recurrent payments"
-                )
+                for telegram_id, bucket in await self.__get_users_to_notify(session):
+                    if bucket == KONE_DAY_LEFT:
+                        result.one_day_left.add(telegram_id)
+                    else:
+                        result.three_days_left.add(telegram_id)
 
-                unique_telegram_ids = users_1day_left | users_3days_left
                 self.__logger.info(
-                    f"total unique users to check for notifications: {len(unique_telegram_ids)}"
-                )
-
-                if not unique_telegram_ids:
-                    return NotifyAboutSubscriptionExpiration()
-
-                user_ids_statement = select(User.id).where(
-                    User.telegram_id.in_(unique_telegram_ids)
+                    f"after filtering already notified & recurrent: {len(result.one_day_left)} (1d) and "
+                    f"{len(result.three_days_left)} (3d)"
                 )
 
-                already_notified_result = await session.execute(
-                    select(User.telegram_id, ESN.one_day_before, ESN.three_days_before)
-                    .join(User, User.id == ESN.user_id)
-                    .where(ESN.user_id.in_(user_ids_statement))
-                )
-
-                for (
-                    telegram_id,
-                    one_day_left,
-                    three_days_left,
-                ) in already_notified_result:
-                    if one_day_left:
-                        users_1day_left.discard(telegram_id)
+                if on_found is not None:
+                    await on_found(session, result)
 
-                    if three_days_left:
-                        users_3days_left.discard(telegram_id)
+                return result
 
-                for telegram_id in users_with_recurrent:
-                    users_1day_left.discard(telegram_id)
-                    users_3days_left.discard(telegram_id)
+    async def __get_users_to_notify(
+        self, session: AsyncSession
+    ) -> list[tuple[int, int]]:
+        """
+        Один запрос вместо четырех: окна 1/3 дня, исключение рекуррентов и уже
+        уведомленных делаются в Postgres через анти-джойны.
 
-                self.__logger.info(
-                    f"after filtering already notified & recurrent: {len(users_1day_left)} (1d) and "
-                    f"{len(users_3days_left)} (3d)"
-                )
+        WITH candidates AS (
+            SELECT id, telegram_id, CASE ... END AS bucket
+            FROM users
+            WHERE <1 day window> OR <3 days window>
+        )
+        SELECT telegram_id, bucket FROM candidates c
+        WHERE
+            NOT EXISTS (SELECT 1 FROM <YkRecurrentPayment> WHERE user_id = c.id) AND
+            NOT EXISTS (SELECT 1 FROM extend_subscription_notifications esn
+                        WHERE esn.user_id = c.id AND <flag of bucket>)
+        """
 
-                return NotifyAboutSubscriptionExpiration(
-                    one_day_left=users_1day_left, three_days_left=users_3days_left
-                )
+        ESN = ExtendSubscriptionNotification
 
-    async def __get_1day_left_users(self, session: AsyncSession) -> set[int]:
-        result = await session.execute(
-            select(User.telegram_id).where(
-                User.expire_at.isnot(None),
-                User.expire_at - func.now() <= text("INTERVAL '1 day'"),
-                User.expire_at - func.now() > text("INTERVAL '0 seconds'"),
+        one_day_window = expire_at_between(timedelta(0), timedelta(days=1))
+        three_days_window = expire_at_between(timedelta(days=2), timedelta(days=3))
+
+        candidates = (
+            select(
+                User.id.label("user_id"),
+                User.telegram_id.label("telegram_id"),
+                case(
+                    (one_day_window, literal(KONE_DAY_LEFT)),
+                    else_=literal(KTHREE_DAYS_LEFT),
+                ).label("bucket"),
             )
+            .where(or_(one_day_window, three_days_window))
+            .cte("candidates")
         )
 
-        return set(row[0] for row in result.fetchall())
-
-    async def __get_3days_left_users(self, session: AsyncSession) -> set[int]:
-        result = await session.execute(
-            select(User.telegram_id).where(
-                User.expire_at.isnot(None),
-                User.expire_at - func.now() <= text("INTERVAL '3 days'"),
-                User.expire_at - func.now() > text("INTERVAL '2 days'"),
-            )
+        has_recurrent = exists().where(
+            YkRecurrentPayment.user_id == candidates.c.user_id
         )
 
-        return set(row[0] for row in result.fetchall())
+        already_notified = exists().where(
+            ESN.user_id == candidates.c.user_id,
+            or_(
+                and_(
+                    candidates.c.bucket == KONE_DAY_LEFT, ESN.one_day_before.is_(True)
+                ),
+                and_(
+                    candidates.c.bucket == KTHREE_DAYS_LEFT,
+                    ESN.three_days_before.is_(True),
+                ),
+            ),
+        )
 
-    async def __get_tg_ids_with_recurrent(self, session: AsyncSession) -> set[int]:
-        result = await session.execute(
-            select(User.telegram_id).join(
-                YkRecurrentPayment, User.id == YkRecurrentPayment.user_id
+        with DB_STATEMENT_DURATION.labels(group="subscription_candidates").time():
+            result = await session.execute(
+                select(candidates.c.telegram_id, candidates.c.bucket).where(
+                    ~has_recurrent, ~already_notified
+                )
             )
-        )
 
-        return set(row[0] for row in result.fetchall())
+        return result.tuples().all()
 
     async def __clear_extend_subscription_notifications_table(
         self, session: AsyncSession
@@ -128,18 +136,19 @@ class SubscriptionExpirationFinder:
             u.expire_at IS NOT NULL AND
             u.expire_at - NOW() > INTERVAL '3 days'
 
+        Теперь окно записано диапазоном (expire_at > NOW() + INTERVAL '3 days'),
+        чтобы работал индекс по expire_at.
+
         """
 
-        long_subscriptions = select(User.id).where(
-            User.expire_at.isnot(None),
-            User.expire_at - func.now() > text("INTERVAL '3 days'"),
-        )
+        long_subscriptions = select(User.id).where(expire_at_after(timedelta(days=3)))
 
-        await session.execute(
-            delete(ExtendSubscriptionNotification).where(
-                ExtendSubscriptionNotification.user_id.in_(long_subscriptions)
+        with DB_STATEMENT_DURATION.labels(group="subscription_cleanup").time():
+            await session.execute(
+                delete(ExtendSubscriptionNotification).where(
+                    ExtendSubscriptionNotification.user_id.in_(long_subscriptions)
+                )
             )
-        )
 
         self.__logger.info(
             f"cleared {ExtendSubscriptionNotification.__tablename__} table for long-term subscriptions"
@@ -0,0 +1,419 @@
+"""
+Микробенчмарки стадий на локальных заглушках.
+
+    python -m tools.bench [--users 10000,100000,1000000] [--repeat 5]
+                          [--stages nc_users,redis_publisher] [--output bench.json]
+
+Для каждого масштаба создается одноразовая база на сервере из MI_UN_POSTGRES_*
+(нужны права CREATEDB), таблицы создаются по моделям common.models.db и
+заполняются синтетическими пользователями. Пользователи RWMS - синтетические
+proto.UserResponse, Redis - fakeredis в том же процессе. Зависимости инструментов
+в образ не попадают: pip install -r requirements-dev.txt.
+
+Каждая стадия прогоняется repeat раз для латентности и еще один раз под
+tracemalloc для пикового объема Python-аллокаций. Результат - JSON в stdout
+или в --output, чтобы сравнивать прогоны между коммитами.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import fakeredis
+import proto.rwmanager_pb2 as proto
+from types import SimpleNamespace
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import MI_UN_POSTGRES_HOST
+from config import MI_UN_POSTGRES_PORT
+from config import MI_UN_POSTGRES_USER
+from config import MI_UN_POSTGRES_PASSWORD
+from config import MI_UN_POSTGRES_DB
+from common.models.db import User
+from common.models.db import UserTrafficProgress
+from common.models.db import NcUsersNotification
+from common.models.db import ExpiredUsersNotification
+from common.models.db import ExtendSubscriptionNotification
+from message_templates import notification_payloads
+from metrics import current_rss_bytes
+from redis_publisher import RedisPublisher
+from redis_publisher import BOT_QUEUES
+from notification_outbox import OUTBOX_TABLE
+from nc_users_finder import NcUsersFinder
+from expired_users_finder import ExpiredUsersFinder
+from user_traffic_progress_watcher import K5MB, K100MB
+from user_traffic_progress_watcher import UserTrafficProgressWatcher
+from subscription_expiration_finder import SubscriptionExpirationFinder
+
+KTELEGRAM_ID_BASE = 100_000_000
+KCHANGED_TRAFFIC_SHARE = 0.01
+
+STAGES = (
+    "nc_users",
+    "expired_users",
+    "subscription_expiration",
+    "traffic_progress_full",
+    "traffic_progress_incremental",
+    "redis_publisher",
+)
+
+# i % 10 определяет expire_at пользователя: без подписки, истекла, 1 день, 3 дня, длинная
+SEED_USERS_QUERY = text(f"""
+    INSERT INTO {User.__tablename__} (id, telegram_id, username, expire_at)
+    SELECT
+        i,
+        {KTELEGRAM_ID_BASE} + i,
+        ({KTELEGRAM_ID_BASE} + i)::text,
+        CASE
+            WHEN i % 10 = 0 THEN NULL
+            WHEN i % 10 IN (1, 2) THEN now() - interval '5 hours'
+            WHEN i % 10 = 3 THEN now() + interval '12 hours'
+            WHEN i % 10 = 4 THEN now() + interval '60 hours'
+            ELSE now() + interval '30 days'
+        END
+    FROM generate_series(1, :n) AS i
+    """)
+
+SEED_NOTIFICATIONS_QUERIES = (
+    text(
+        f"INSERT INTO {NcUsersNotification.__tablename__} (user_id) "
+        f"SELECT i FROM generate_series(1, :n) AS i WHERE i % 20 = 0"
+    ),
+    text(
+        f"INSERT INTO {ExpiredUsersNotification.__tablename__} (user_id) "
+        f"SELECT i FROM generate_series(1, :n) AS i WHERE i % 10 = 1"
+    ),
+    text(
+        f"INSERT INTO {ExtendSubscriptionNotification.__tablename__} "
+        f"(user_id, one_day_before, three_days_before) "
+        f"SELECT i, true, false FROM generate_series(1, :n) AS i WHERE i % 20 = 3"
+    ),
+)
+
+RESET_PROGRESS_QUERIES = (
+    text(f"DELETE FROM {UserTrafficProgress.__tablename__}"),
+    text(
+        f"INSERT INTO {UserTrafficProgress.__tablename__} "
+        f"(user_id, passed_0, passed_5mb, passed_100mb) "
+        f"SELECT i, false, false, false FROM generate_series(1, :n) AS i"
+    ),
+)
+
+
+def server_url(database: str) -> str:
+    return (
+        f"postgresql+asyncpg://{os.getenv(MI_UN_POSTGRES_USER)}:{os.getenv(MI_UN_POSTGRES_PASSWORD)}"
+        f"@{os.getenv(MI_UN_POSTGRES_HOST)}:{os.getenv(MI_UN_POSTGRES_PORT)}/{database}"
+    )
+
+
+# Одноразовая база на сервере MI_UN_POSTGRES_*, удаляется при выходе
+@asynccontextmanager
+async def throwaway_database(name: str) -> AsyncIterator[AsyncEngine]:
+    admin = create_async_engine(
+        server_url(os.getenv(MI_UN_POSTGRES_DB)), isolation_level="AUTOCOMMIT"
+    )
+
+    async with admin.connect() as connection:
+        await connection.execute(text(f'CREATE DATABASE "{name}"'))
+
+    engine = create_async_engine(server_url(name))
+
+    try:
+        yield engine
+    finally:
+        await engine.dispose()
+
+        async with admin.connect() as connection:
+            await connection.execute(
+                text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+            )
+
+        await admin.dispose()
+
+
+async def seed_database(engine: AsyncEngine, users_count: int) -> None:
+    t0 = time.perf_counter()
+
+    async with engine.begin() as connection:
+        await connection.run_sync(User.metadata.create_all)
+        await connection.run_sync(OUTBOX_TABLE.metadata.create_all)
+        await connection.execute(SEED_USERS_QUERY, {"n": users_count})
+
+        for query in SEED_NOTIFICATIONS_QUERIES:
+            await connection.execute(query, {"n": users_count})
+
+        for query in RESET_PROGRESS_QUERIES:
+            await connection.execute(query, {"n": users_count})
+
+        await connection.execute(text("ANALYZE"))
+
+    logging.warning(f"seeded {users_count} users in {time.perf_counter()-t0:.2f}s")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def make_users(n: int) -> list[proto.UserResponse]:
+    yesterday = datetime.now() - timedelta(days=1)
+    month_ago = datetime.now() - timedelta(days=30)
+    traffic_levels = (0, 1024 * 1024, K5MB + 1, K100MB + 1)
+
+    users = []
+
+    for i in range(1, n + 1):
+        user = proto.UserResponse(
+            uuid=str(uuid.UUID(int=i)),
+            username=str(KTELEGRAM_ID_BASE + i),
+            lifetime_used_traffic_bytes=traffic_levels[i % len(traffic_levels)],
+        )
+        user.created_at.FromDatetime(yesterday if i % 7 == 0 else month_ago)
+        users.append(user)
+
+    return users
+
+
+def grow_traffic(users: list[proto.UserResponse], share: float) -> None:
+    step = max(1, int(1 / share))
+
+    for user in users[::step]:
+        user.lifetime_used_traffic_bytes += K5MB
+
+
+async def measure(
+    run: Callable[[], Awaitable[None]],
+    units: int,
+    repeat: int,
+    prepare: Optional[Callable[[], Awaitable[None]]] = None,
+) -> dict:
+    latencies = []
+
+    for _ in range(repeat):
+        if prepare is not None:
+            await prepare()
+
+        t0 = time.perf_counter()
+        await run()
+        latencies.append(time.perf_counter() - t0)
+
+    # отдельный прогон под tracemalloc, чтобы трассировка не искажала латентность
+    if prepare is not None:
+        await prepare()
+
+    tracemalloc.start()
+
+    try:
+        await run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50, p99 = np.percentile(latencies, [50, 99]).tolist()
+
+    return {
+        "units": units,
+        "repeat": repeat,
+        "p50_seconds": p50,
+        "p99_seconds": p99,
+        "mean_seconds": sum(latencies) / len(latencies),
+        "throughput_per_second": units / p50 if p50 > 0 else None,
+        "peak_traced_bytes": peak,
+        "rss_bytes": current_rss_bytes(),
+    }
+
+
+class ScaleBench:
+    def __init__(
+        self,
+        users_count: int,
+        repeat: int,
+        batch_size: int,
+        redis_backend: str,
+        redis_stream_maxlen: int,
+        redis_fanout: bool,
+    ):
+        self.__users_count = users_count
+        self.__repeat = repeat
+        self.__batch_size = batch_size
+        self.__redis_backend = redis_backend
+        self.__redis_stream_maxlen = redis_stream_maxlen
+        self.__redis_fanout = redis_fanout
+        self.__database = f"mi_un_bench_{os.getpid()}_{users_count}"
+
+    async def run(self, stages: list[str]) -> dict:
+        async with throwaway_database(self.__database) as engine:
+            await seed_database(engine, self.__users_count)
+            return await self.__run_stages(engine, stages)
+
+    async def __run_stages(self, engine: AsyncEngine, stages: list[str]) -> dict:
+
+        session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+        users = make_users(self.__users_count)
+        n = self.__users_count
+        repeat = self.__repeat
+        results = {}
+
+        async def reset_progress() -> None:
+            async with engine.begin() as connection:
+                for query in RESET_PROGRESS_QUERIES:
+                    await connection.execute(query, {"n": n})
+
+        if "nc_users" in stages:
+            finder = NcUsersFinder(session_maker=session_maker)
+
+            async def nc_users() -> None:
+                await finder.find(users)
+
+            results["nc_users"] = await measure(nc_users, n, repeat)
+
+        if "expired_users" in stages:
+            finder = ExpiredUsersFinder(session_maker=session_maker)
+            results["expired_users"] = await measure(finder.find, n, repeat)
+
+        if "subscription_expiration" in stages:
+            finder = SubscriptionExpirationFinder(session_maker=session_maker)
+            results["subscription_expiration"] = await measure(finder.find, n, repeat)
+
+        # бонусы не начисляются (в синтетике нет рефереров), поэтому RWMS не нужен
+        if "traffic_progress_full" in stages:
+
+            async def traffic_progress_full() -> None:
+                watcher = UserTrafficProgressWatcher(
+                    sync_user_progress=False, session_maker=session_maker
+                )
+                await watcher.find(None, users)
+
+            results["traffic_progress_full"] = await measure(
+                traffic_progress_full, n, repeat, prepare=reset_progress
+            )
+
+        if "traffic_progress_incremental" in stages:
+            await reset_progress()
+
+            watcher = UserTrafficProgressWatcher(
+                sync_user_progress=False, session_maker=session_maker
+            )
+            await watcher.find(None, users)
+
+            async def traffic_progress_incremental() -> None:
+                await watcher.find(None, users)
+
+            async def grow() -> None:
+                grow_traffic(users, KCHANGED_TRAFFIC_SHARE)
+
+            results["traffic_progress_incremental"] = await measure(
+                traffic_progress_incremental, n, repeat, prepare=grow
+            )
+
+        if "redis_publisher" in stages:
+            redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+            publisher = RedisPublisher(
+                config=SimpleNamespace(
+                    redis_batch_size=self.__batch_size,
+                    redis_backend=self.__redis_backend,
+                    redis_stream_maxlen=self.__redis_stream_maxlen,
+                    redis_fanout=self.__redis_fanout,
+                    redis_backpressure=False,
+                ),
+                redis=redis,
+            )
+            telegram_ids = range(KTELEGRAM_ID_BASE + 1, KTELEGRAM_ID_BASE + n + 1)
+
+            # рендер шаблонов входит в замер: это вся работа публикации после finder'а
+            async def redis_publisher() -> None:
+                payloads = notification_payloads("subscription-expired", telegram_ids)
+                await publisher.push_payloads(payloads, BOT_QUEUES)
+
+            results["redis_publisher"] = await measure(
+                redis_publisher, n, repeat, prepare=redis.flushall
+            )
+
+        return results
+
+
+async def main(args: argparse.Namespace) -> dict:
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "repeat": args.repeat,
+        "scales": {},
+    }
+
+    for users_count in args.users:
+        bench = ScaleBench(
+            users_count,
+            args.repeat,
+            args.batch_size,
+            args.redis_backend,
+            args.redis_stream_maxlen,
+            args.redis_fanout,
+        )
+        report["scales"][str(users_count)] = await bench.run(args.stages)
+
+    return report
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--users",
+        type=lambda value: [int(n) for n in value.split(",")],
+        default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--stages",
+        type=lambda value: value.split(","),
+        default=list(STAGES),
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--redis-backend", choices=["list", "stream"], default="list")
+    parser.add_argument("--redis-stream-maxlen", type=int, default=1_000_000)
+    # fan-out через Lua на fakeredis требует lupa: fakeredis[lua] в requirements-dev.txt
+    parser.add_argument("--redis-fanout", action="store_true")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    unknown = set(args.stages) - set(STAGES)
+
+    if unknown:
+        parser.error(f"unknown stages: {sorted(unknown)}, known: {list(STAGES)}")
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # логи finder'ов на каждого пользователя исказили бы замеры
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    report = asyncio.run(main(args))
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,92 @@
+"""
+Проверка, что окна по expire_at из finder'ов используют индекс.
+
+    python -m tools.explain_expire_at [--no-seqscan]
+
+Подключение берется из MI_UN_POSTGRES_* переменных. На маленькой таблице
+планировщику выгоднее seq scan, поэтому --no-seqscan выключает его для сессии
+и проверяет, что индекс в принципе применим. Код возврата 1, если хотя бы
+одно окно читает users без индекса.
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+from datetime import timedelta
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import MI_UN_POSTGRES_HOST
+from config import MI_UN_POSTGRES_PORT
+from config import MI_UN_POSTGRES_USER
+from config import MI_UN_POSTGRES_PASSWORD
+from config import MI_UN_POSTGRES_DB
+from common.models.db import User
+from expire_at_predicates import expire_at_after
+from expire_at_predicates import expire_at_between
+from expire_at_predicates import expire_at_not_after
+
+INDEX_SCANS = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+WINDOWS = {
+    "expired": expire_at_not_after(),
+    "no longer expired": expire_at_after(),
+    "1 day left": expire_at_between(timedelta(0), timedelta(days=1)),
+    "3 days left": expire_at_between(timedelta(days=2), timedelta(days=3)),
+    "long subscriptions": expire_at_after(timedelta(days=3)),
+}
+
+
+def scan_nodes(plan: dict) -> list[tuple[str, str]]:
+    nodes = []
+
+    if plan.get("Relation Name") == "users" or plan.get("Node Type") in INDEX_SCANS:
+        nodes.append((plan["Node Type"], plan.get("Index Name", "")))
+
+    for child in plan.get("Plans", []):
+        nodes.extend(scan_nodes(child))
+
+    return nodes
+
+
+async def main(no_seqscan: bool) -> int:
+    engine = create_async_engine(
+        f"postgresql+asyncpg://{os.getenv(MI_UN_POSTGRES_USER)}:{os.getenv(MI_UN_POSTGRES_PASSWORD)}"
+        f"@{os.getenv(MI_UN_POSTGRES_HOST)}:{os.getenv(MI_UN_POSTGRES_PORT)}/{os.getenv(MI_UN_POSTGRES_DB)}"
+    )
+
+    failed = 0
+
+    async with engine.connect() as connection:
+        if no_seqscan:
+            await connection.exec_driver_sql("SET enable_seqscan = off")
+
+        for name, predicate in WINDOWS.items():
+            statement = select(User.id, User.telegram_id).where(predicate)
+            sql = statement.compile(
+                dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+            )
+
+            result = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}")
+            plan = result.scalar()[0]["Plan"]
+            nodes = scan_nodes(plan)
+            uses_index = any(node_type in INDEX_SCANS for node_type, _ in nodes)
+
+            if not uses_index:
+                failed += 1
+
+            print(f"{'OK  ' if uses_index else 'FAIL'} {name}: {nodes}")
+
+    await engine.dispose()
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-seqscan", action="store_true")
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(no_seqscan=args.no_seqscan)))
@@ -0,0 +1,324 @@
+"""
+Длительный прогон итераций против фейкового RwManager.
+
+    python -m tools.soak [--users 1000000] [--iterations 50] [--page-latency 0.02]
+                         [--page-error-rate 0.01] [--growth-share 0.01]
+                         [--max-rss-growth-mb 200] [--output soak.json]
+
+В процессе поднимается gRPC сервер с RwManagerServicer, который отдает
+синтетическую популяцию постранично (страницы генерируются на лету, в памяти
+сервера пользователи не хранятся), с задержкой, случайными ошибками страниц и
+ростом трафика части пользователей от итерации к итерации. База - одноразовая,
+как в tools.bench, Redis - fakeredis (requirements-dev.txt); очереди вычитываются
+после каждой итерации.
+
+Итерация - один тик планировщика, в котором подошли все стадии: вызовы из
+scheduled_stages(), те же, что main() регистрирует в Scheduler, запускаются
+одновременно. Записываются длительность, число сообщений по очередям и RSS. Код возврата 1, если рост RSS после прогрева больше
+--max-rss-growth-mb.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import grpc
+import numpy as np
+import fakeredis
+import proto.rwmanager_pb2 as proto
+import proto.rwmanager_pb2_grpc as proto_grpc
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Config
+from config import MI_UN_RWMS_ADDR
+from config import MI_UN_RWMS_PORT
+from config import MI_UN_REDIS_HOST
+from config import MI_UN_REDIS_PORT
+from config import MI_UN_REDIS_PASSWORD
+from main import UserNotifyStages
+from main import scheduled_stages
+from metrics import current_rss_bytes
+from redis_publisher import RedisPublisher
+from redis_publisher import KSTREAM_BACKEND
+from redis_publisher import VPN_BOT_QUEUE
+from redis_publisher import VPS_BOT_QUEUE
+from redis_publisher import YM_STAT_QUEUE
+from notification_outbox import OutboxDrainer
+from tools.bench import KTELEGRAM_ID_BASE
+from tools.bench import git_revision
+from tools.bench import seed_database
+from tools.bench import throwaway_database
+from user_traffic_progress_watcher import K5MB, K100MB
+
+KQUEUES = (VPN_BOT_QUEUE, VPS_BOT_QUEUE, YM_STAT_QUEUE)
+KTRAFFIC_LEVELS = (0, 1024 * 1024, K5MB + 1, K100MB + 1)
+
+
+class FakeRwManager(proto_grpc.RwManagerServicer):
+    """
+    Пользователь i: username = KTELEGRAM_ID_BASE + i (как в seed_database),
+    каждый 7-й создан вчера. У каждого growth_stride-го трафик растет на
+    growth_bytes за итерацию (epoch), у остальных он постоянный.
+    """
+
+    def __init__(
+        self,
+        users_count: int,
+        page_latency: float,
+        page_latency_jitter: float,
+        page_error_rate: float,
+        growth_share: float,
+        growth_bytes: int,
+    ):
+        self.users_count = users_count
+        self.page_latency = page_latency
+        self.page_latency_jitter = page_latency_jitter
+        self.page_error_rate = page_error_rate
+        self.growth_stride = max(1, int(1 / growth_share)) if growth_share else 0
+        self.growth_bytes = growth_bytes
+        self.epoch = 0
+
+        self.pages_served = 0
+        self.page_errors = 0
+        self.updates = 0
+
+        self.__yesterday = datetime.now() - timedelta(days=1)
+        self.__month_ago = datetime.now() - timedelta(days=30)
+
+    def advance(self) -> None:
+        self.epoch += 1
+
+    def make_user(self, i: int) -> proto.UserResponse:
+        if self.growth_stride and i % self.growth_stride == 0:
+            traffic = self.epoch * self.growth_bytes
+        else:
+            traffic = KTRAFFIC_LEVELS[i % len(KTRAFFIC_LEVELS)]
+
+        user = proto.UserResponse(
+            uuid=str(uuid.UUID(int=i)),
+            username=str(KTELEGRAM_ID_BASE + i),
+            lifetime_used_traffic_bytes=traffic,
+        )
+        user.created_at.FromDatetime(
+            self.__yesterday if i % 7 == 0 else self.__month_ago
+        )
+
+        return user
+
+    async def GetAllUsers(self, request, context):
+        await asyncio.sleep(
+            self.page_latency + random.uniform(0, self.page_latency_jitter)
+        )
+
+        if random.random() < self.page_error_rate:
+            self.page_errors += 1
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "injected page error")
+
+        self.pages_served += 1
+        start = request.offset + 1
+        stop = min(request.offset + request.count, self.users_count) + 1
+
+        return proto.GetAllUsersReply(
+            users=[self.make_user(i) for i in range(start, stop)],
+            total=self.users_count,
+        )
+
+    async def GetUserByUsername(self, request, context):
+        i = int(request.username) - KTELEGRAM_ID_BASE
+
+        if not 1 <= i <= self.users_count:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "user not found")
+
+        return self.make_user(i)
+
+    async def UpdateUser(self, request, context):
+        self.updates += 1
+        return self.make_user(uuid.UUID(request.uuid).int)
+
+
+async def run_soak(args: argparse.Namespace) -> dict:
+    servicer = FakeRwManager(
+        users_count=args.users,
+        page_latency=args.page_latency,
+        page_latency_jitter=args.page_latency_jitter,
+        page_error_rate=args.page_error_rate,
+        growth_share=args.growth_share,
+        growth_bytes=args.growth_bytes,
+    )
+
+    server = grpc.aio.server()
+    proto_grpc.add_RwManagerServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+
+    os.environ[MI_UN_RWMS_ADDR] = "127.0.0.1"
+    os.environ[MI_UN_RWMS_PORT] = str(port)
+
+    # Redis подменяется fakeredis, переменные нужны только чтобы собрать Config
+    os.environ.setdefault(MI_UN_REDIS_HOST, "fakeredis")
+    os.environ.setdefault(MI_UN_REDIS_PORT, "6379")
+    os.environ.setdefault(MI_UN_REDIS_PASSWORD, "fakeredis")
+
+    iterations = []
+
+    try:
+        async with throwaway_database(f"mi_un_soak_{os.getpid()}") as engine:
+            await seed_database(engine, args.users)
+
+            config = Config()
+            redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+            session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+            publisher = RedisPublisher(config=config, redis=redis)
+            stages = UserNotifyStages(
+                config=config, session_maker=session_maker, publisher=publisher
+            )
+
+            # close() останавливает пул декодирования страниц и его gRPC канал
+            try:
+                # с MI_UN_OUTBOX=true сообщения доходят до Redis только через drainer
+                drainer = None
+
+                if config.outbox_enabled:
+                    drainer = OutboxDrainer(
+                        session_maker=session_maker,
+                        publisher=publisher,
+                        batch_size=config.outbox_batch_size,
+                    )
+
+                for iteration in range(args.iterations):
+                    t0 = time.perf_counter()
+                    await run_tick(config, stages)
+                    duration = time.perf_counter() - t0
+
+                    drain_duration = 0.0
+
+                    if drainer is not None:
+                        t0 = time.perf_counter()
+                        await drainer.drain()
+                        drain_duration = time.perf_counter() - t0
+
+                    messages = {
+                        queue: await queue_length(redis, config, queue)
+                        for queue in KQUEUES
+                    }
+                    await redis.flushall()
+
+                    gc.collect()
+                    rss = current_rss_bytes()
+
+                    iterations.append(
+                        {
+                            "iteration": iteration,
+                            "duration_seconds": duration,
+                            "drain_seconds": drain_duration,
+                            "messages": messages,
+                            "rss_bytes": rss,
+                            "pages_served": servicer.pages_served,
+                            "page_errors": servicer.page_errors,
+                        }
+                    )
+
+                    logging.warning(
+                        f"iteration {iteration}: {duration:.2f}s, messages {messages}, "
+                        f"rss {rss / 2**20:.1f} MiB"
+                    )
+
+                    servicer.advance()
+            finally:
+                await stages.close()
+    finally:
+        await server.stop(grace=None)
+
+    return {
+        "revision": git_revision(),
+        "users": args.users,
+        "iterations": iterations,
+        "summary": summarize(iterations, args.warmup),
+        "rwms": {
+            "pages_served": servicer.pages_served,
+            "page_errors": servicer.page_errors,
+            "updates": servicer.updates,
+        },
+    }
+
+
+# Один тик, в котором подошли все стадии. В потоковом режиме not connected users
+# и traffic progress так же, как в main(), делят один проход по RWMS
+async def run_tick(config: Config, stages: UserNotifyStages) -> None:
+    async with asyncio.TaskGroup() as tg:
+        for name, _, _, stage in scheduled_stages(config, stages):
+            tg.create_task(stages.run_stage(name, stage))
+
+
+async def queue_length(redis, config: Config, queue: str) -> int:
+    if config.redis_backend == KSTREAM_BACKEND:
+        return await redis.xlen(queue)
+
+    return await redis.llen(queue)
+
+
+def summarize(iterations: list[dict], warmup: int) -> dict:
+    durations = [it["duration_seconds"] for it in iterations]
+    measured = iterations[warmup:] or iterations
+    rss = np.array([it["rss_bytes"] for it in measured], dtype=np.float64)
+
+    # наклон RSS по итерациям после прогрева: у утечки он стабильно положительный
+    slope = float(np.polyfit(np.arange(len(rss)), rss, 1)[0]) if len(rss) > 1 else 0.0
+
+    return {
+        "duration_p50_seconds": float(np.percentile(durations, 50)),
+        "duration_max_seconds": max(durations),
+        "messages_total": {
+            queue: sum(it["messages"][queue] for it in iterations) for queue in KQUEUES
+        },
+        "rss_after_warmup_bytes": int(rss[0]),
+        "rss_last_bytes": int(rss[-1]),
+        "rss_growth_bytes": int(rss[-1] - rss[0]),
+        "rss_slope_bytes_per_iteration": slope,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--page-latency", type=float, default=0.02)
+    parser.add_argument("--page-latency-jitter", type=float, default=0.01)
+    parser.add_argument("--page-error-rate", type=float, default=0.01)
+    parser.add_argument("--growth-share", type=float, default=0.01)
+    parser.add_argument("--growth-bytes", type=int, default=K5MB)
+    parser.add_argument("--max-rss-growth-mb", type=float)
+    parser.add_argument("--output")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    report = asyncio.run(run_soak(args))
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    growth = report["summary"]["rss_growth_bytes"]
+
+    if args.max_rss_growth_mb is not None and growth > args.max_rss_growth_mb * 2**20:
+        logging.error(
+            f"RSS grew by {growth / 2**20:.1f} MiB after warmup, "
+            f"limit is {args.max_rss_growth_mb} MiB"
+        )
+        sys.exit(1)
@@ -0,0 +1,77 @@
+import time
+import logging
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from metrics import DB_STATEMENT_DURATION
+
+SYNC_TABLE = "user_traffic_progress_sync"
+SYNC_COLUMNS = ("telegram_id", "passed_0", "passed_5mb", "passed_100mb")
+
+CREATE_SYNC_TABLE_QUERY = text(f"""
+    CREATE TEMP TABLE {SYNC_TABLE} (
+        telegram_id bigint NOT NULL,
+        passed_0 boolean NOT NULL,
+        passed_5mb boolean NOT NULL,
+        passed_100mb boolean NOT NULL
+    ) ON COMMIT DROP
+    """)
+
+MERGE_SYNC_TABLE_QUERY = text(f"""
+    INSERT INTO user_traffic_progress (user_id, passed_0, passed_5mb, passed_100mb)
+        SELECT DISTINCT ON (u.id) u.id, s.passed_0, s.passed_5mb, s.passed_100mb
+        FROM {SYNC_TABLE} s
+        JOIN users u ON u.telegram_id = s.telegram_id
+        ORDER BY u.id
+        ON CONFLICT (user_id) DO NOTHING
+    """)
+
+
+class UserProgressSyncResult(BaseModel):
+    total: int = 0
+    inserted: int = 0
+    skipped: int = 0
+
+
+class UserProgressBulkSync:
+    def __init__(self, session_maker: async_sessionmaker):
+        self.__log = logging.getLogger(self.__class__.__name__)
+        self.__session_maker = session_maker
+
+    # rows: (telegram_id, passed_0, passed_5mb, passed_100mb)
+    async def sync(
+        self, rows: list[tuple[int, bool, bool, bool]]
+    ) -> UserProgressSyncResult:
+        t0 = time.monotonic()
+
+        async with self.__session_maker() as session:
+            async with session.begin():
+                # Временную таблицу создаем через сессию, чтобы она попала в открытую транзакцию
+                await session.execute(CREATE_SYNC_TABLE_QUERY)
+
+                connection = await session.connection()
+                raw_connection = await connection.get_raw_connection()
+
+                # asyncpg выполняет copy_records_to_table через бинарный COPY
+                await raw_connection.driver_connection.copy_records_to_table(
+                    SYNC_TABLE, records=rows, columns=SYNC_COLUMNS
+                )
+
+                merged = await session.execute(MERGE_SYNC_TABLE_QUERY)
+
+        DB_STATEMENT_DURATION.labels(group="progress_sync").observe(
+            time.monotonic() - t0
+        )
+
+        result = UserProgressSyncResult(
+            total=len(rows),
+            inserted=merged.rowcount,
+            skipped=len(rows) - merged.rowcount,
+        )
+
+        self.__log.info(
+            f"synchronized user_traffic_progress: {result.inserted} inserted, "
+            f"{result.skipped} skipped of {result.total} (took {time.monotonic()-t0:.2f}s)"
+        )
+
+        return result
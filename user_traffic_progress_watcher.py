@@ -1,13 +1,18 @@
+import time
+import asyncio
 import logging
+import numpy as np
 import proto.rwmanager_pb2 as proto
 from datetime import timezone
 from datetime import datetime
 from datetime import timedelta
 from typing import Tuple
+from typing import Iterable
 from typing import Optional
-from pydantic import BaseModel
+from typing import NamedTuple
+from typing import Callable
+from typing import Awaitable
 from sqlalchemy import select
-from sqlalchemy import update
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
@@ -18,32 +23,72 @@ from common.models.db import ReferralBonus
 from common.models.db import ReferralBonusType
 from common.models.db import ReferralType
 from common.models.messages import ConversionEvent
+from user_progress_sync import UserProgressBulkSync
+from users_snapshot import UsersSnapshot
+from compact_state import KNO_USER_ID
+from compact_state import decode_uuids
+from compact_state import ProgressTable
+from compact_state import TrafficSnapshotTable
+from metrics import DB_STATEMENT_DURATION, TRAFFIC_SNAPSHOT_SIZE, USERS_SCANNED
+
+# (session, conversions, bonuses) -> None, вызывается в транзакции обновления прогресса
+OnProgressApplied = Callable[
+    [AsyncSession, list[tuple[str, ConversionEvent]], dict[int, int]], Awaitable[None]
+]
 
 K5MB = 5 * 1024 * 1024
 K100MB = 100 * 1024 * 1024
+# трафик в снапшоте для пользователя, которого надо оценить заново в следующем цикле
+KRETRY_TRAFFIC = -1.0
 K15MINUTES = 15 * 60
-
-
-async def extend_user_subscription_by_username(
+KPROGRESS_UPDATE_BATCH = 10000
+KPROGRESS_LOOKUP_BATCH = 5000
+KSNAPSHOT_LOOKUP_BATCH = 5000
+
+KPASSED_0 = 1
+KPASSED_5MB = 2
+KPASSED_100MB = 4
+
+# Флаги только поднимаются: OR со старым значением, чтобы не сбросить уже выставленные
+BULK_UPDATE_PROGRESS_QUERY = text("""
+    UPDATE user_traffic_progress AS utp
+        SET
+            passed_0 = utp.passed_0 OR v.passed_0,
+            passed_5mb = utp.passed_5mb OR v.passed_5mb,
+            passed_100mb = utp.passed_100mb OR v.passed_100mb
+        FROM unnest(
+            CAST(:user_ids AS bigint[]),
+            CAST(:passed_0 AS boolean[]),
+            CAST(:passed_5mb AS boolean[]),
+            CAST(:passed_100mb AS boolean[])
+        ) AS v(user_id, passed_0, passed_5mb, passed_100mb)
+        WHERE utp.user_id = v.user_id
+    """)
+
+
+async def extend_users_subscriptions_by_username(
     session: AsyncSession,
-    username: str,
-    interval: timedelta,
+    intervals: dict[str, timedelta],
 ) -> None:
     extend_expire_at_query = text("""
-        UPDATE users 
-            SET expire_at = 
-            CASE 
-                WHEN expire_at > (NOW() AT TIME ZONE 'UTC') THEN expire_at + (:interval)::interval
-                ELSE (NOW() AT TIME ZONE 'UTC') + (:interval)::interval
+        UPDATE users AS u
+            SET expire_at =
+            CASE
+                WHEN u.expire_at > (NOW() AT TIME ZONE 'UTC') THEN u.expire_at + v.interval
+                ELSE (NOW() AT TIME ZONE 'UTC') + v.interval
             END
-            WHERE username = :username
+            FROM unnest(
+                CAST(:usernames AS text[]),
+                CAST(:intervals AS interval[])
+            ) AS v(username, interval)
+            WHERE u.username = v.username
         """)
 
     await session.execute(
         extend_expire_at_query,
         {
-            "username": username,
-            "interval": interval,
+            "usernames": list(intervals.keys()),
+            "intervals": list(intervals.values()),
         },
     )
 
@@ -79,160 +124,527 @@ async def update_user(
     return update_user_response, subscription_activated
 
 
-class UserTrafficProgressDto(BaseModel):
-    user_id: int
-    passed_0: bool
-    passed_5mb: bool
-    passed_100mb: bool
+class TrafficSnapshotEntry(NamedTuple):
+    traffic: float  # lifetime_used_traffic_bytes на момент последней проверки
+    user_id: Optional[int]  # None - у пользователя нет строки в user_traffic_progress
+    flags: int  # KPASSED_* биты
+
+
+def progress_flags(passed_0: bool, passed_5mb: bool, passed_100mb: bool) -> int:
+    return (
+        (KPASSED_0 if passed_0 else 0)
+        | (KPASSED_5MB if passed_5mb else 0)
+        | (KPASSED_100MB if passed_100mb else 0)
+    )
 
 
 class UserTrafficProgressWatcher:
-    def __init__(self, sync_user_progress: bool, session_maker: async_sessionmaker):
+    def __init__(
+        self,
+        sync_user_progress: bool,
+        session_maker: async_sessionmaker,
+        bonus_concurrency: int = 10,
+        reconcile_interval: int = 360,
+    ):
         self.__session_maker = session_maker
+        self.__bonus_concurrency = bonus_concurrency
         self.__sync_user_progress = sync_user_progress
         self.__log = logging.getLogger(self.__class__.__name__)
 
-    # returns a list of tuples of (telegram_id, ConversionEvent)
-    async def find(
-        self, rwms_client: RwmsClient, users: list[proto.UserResponse]
-    ) -> tuple[list[tuple[str, ConversionEvent]], dict[int, int]]:
+        self.__bulk_sync = UserProgressBulkSync(session_maker=session_maker)
+        self.__syncing = False
+        self.__sync_rows: list[tuple[int, bool, bool, bool]] = []
+        self.__user_progress = ProgressTable()
+        self.__users_to_update = []  # tuples of (user_id, column name, value)
+        self.__conversions_to_send = []  # tuples of (username, ConversionEvent)
+        # user_id рефералов, достигших 100мб -> (uuid, username)
+        self.__referrer_bonuses: dict[int, tuple[str, str]] = {}
+
+        # Снапшот по uuid пользователя: между полными сверками проверяем только тех,
+        # у кого изменился трафик, и тех, кого еще не видели. Живет между циклами,
+        # поэтому хранится колонками; изменения цикла копятся в dict
+        self.__snapshot = TrafficSnapshotTable()
+        self.__snapshot_updates: dict[str, TrafficSnapshotEntry] = {}
+        self.__pending_lookups = []  # tuples of (uuid, username, traffic)
+        self.__reconcile_interval = reconcile_interval * 60
+        self.__last_reconciliation = 0.0
+        self.__full_scan = False
+        # продления, прошедшие в RWMS, но не записанные в БД: записываются в
+        # следующем цикле без повторного вызова RWMS
+        self.__unrecorded_bonuses: list[tuple[int, list[int], str, int]] = []
+        # telegram_id реферера -> число бонусов, уведомление о которых не записано
+        self.__unnotified_bonuses: dict[int, int] = {}
+
+    # Инкрементальный режим: begin() -> scan(page) для каждой страницы -> finish()
+    async def begin(self) -> None:
         self.__log.info(f"searching user traffic progress...")
 
-        try:
-            if self.__sync_user_progress:
-                self.__log.info(
-                    f"synchronizing {UserTrafficProgress.__tablename__} table..."
-                )
-                self.__sync_user_progress = False
-                await self.__update_user_progress(users)
+        self.__users_to_update = []
+        self.__conversions_to_send = []
+        self.__referrer_bonuses = {}
+        self.__snapshot_updates = {}
+        self.__pending_lookups = []
+
+        self.__syncing = self.__sync_user_progress
+        self.__sync_rows = []
+
+        if self.__syncing:
+            self.__log.info(
+                f"synchronizing {UserTrafficProgress.__tablename__} table..."
+            )
+            self.__sync_user_progress = False
+
+        self.__full_scan = (
+            self.__syncing
+            or not self.__snapshot
+            or time.monotonic() - self.__last_reconciliation
+            >= self.__reconcile_interval
+        )
+
+        if self.__full_scan:
+            self.__log.info("full traffic progress reconciliation")
 
             async with self.__session_maker() as session:
-                user_progress = await self.__get_users_progress(session=session)
+                self.__user_progress = ProgressTable(
+                    await self.__get_users_progress_rows(session=session)
+                )
 
-            users_to_update = []  # tuples of (user_id, column name, value)
-            conversions_to_send = []  # tuples of (username, ConversionEvent)
-            referrer_bonuses = (
-                []
-            )  # list of user ids of referrers with standard referral type
+    async def scan(self, users: Iterable[proto.UserResponse]) -> None:
+        if self.__syncing:
+            self.__collect_sync_rows(users)
 
-            for user in users:
-                if user.username not in user_progress:
-                    continue
+        users = list(users)
+        USERS_SCANNED.labels(stage="traffic progress").inc(len(users))
 
-                progress: UserTrafficProgressDto = user_progress[user.username]
-                traffic: float = user.lifetime_used_traffic_bytes
+        for start in range(0, len(users), KSNAPSHOT_LOOKUP_BATCH):
+            batch = users[start : start + KSNAPSHOT_LOOKUP_BATCH]
+            self.__scan_users(
+                np.array([user.uuid for user in batch], dtype=str),
+                np.array([user.username for user in batch], dtype=str),
+                np.array([user.lifetime_used_traffic_bytes for user in batch]),
+            )
 
-                if traffic > 0 and not progress.passed_0:
-                    users_to_update.append((progress.user_id, "passed_0", True))
-                    conversions_to_send.append(
-                        (user.username, ConversionEvent.HAS_TRAFFIC)
-                    )
+    # Колоночный режим: пороги считаются масками, изменение трафика - поиском
+    # по снапшоту; в Python доходят только пользователи с изменившимся трафиком
+    async def scan_snapshot(self, snapshot: UsersSnapshot) -> None:
+        USERS_SCANNED.labels(stage="traffic progress").inc(len(snapshot))
+        levels = snapshot.threshold_levels([0, K5MB, K100MB])
+
+        if self.__syncing:
+            valid = snapshot.telegram_ids >= 0
+            self.__sync_rows.extend(
+                zip(
+                    snapshot.telegram_ids[valid].tolist(),
+                    (levels[valid] & KPASSED_0 != 0).tolist(),
+                    (levels[valid] & KPASSED_5MB != 0).tolist(),
+                    (levels[valid] & KPASSED_100MB != 0).tolist(),
+                )
+            )
 
-                if traffic > K5MB and not progress.passed_5mb:
-                    users_to_update.append((progress.user_id, "passed_5mb", True))
-                    conversions_to_send.append(
-                        (user.username, ConversionEvent.HAS_TRAFFIC_MORE_THAN_5MB)
-                    )
+        candidates = np.flatnonzero(levels != 0)
+
+        for start in range(0, len(candidates), KSNAPSHOT_LOOKUP_BATCH):
+            batch = candidates[start : start + KSNAPSHOT_LOOKUP_BATCH]
+            self.__scan_users(
+                snapshot.uuids[batch],
+                snapshot.usernames[batch],
+                snapshot.traffic[batch],
+            )
 
-                if traffic > K100MB and not progress.passed_100mb:
-                    referrer_bonuses.append(progress.user_id)
-                    users_to_update.append((progress.user_id, "passed_100mb", True))
-                    conversions_to_send.append(
-                        (user.username, ConversionEvent.HAS_TRAFFIC_MORE_THAN_100MB)
+    # Батч пользователей (не больше KSNAPSHOT_LOOKUP_BATCH): uuid - str или S36
+    def __scan_users(
+        self, uuids: np.ndarray, usernames: np.ndarray, traffic: np.ndarray
+    ) -> None:
+        if self.__full_scan:
+            for uuid, username, user_traffic in zip(
+                decode_uuids(uuids), usernames.tolist(), traffic.tolist()
+            ):
+                progress = self.__user_progress.get(username)
+
+                if progress is None:
+                    self.__snapshot_updates[uuid] = TrafficSnapshotEntry(
+                        user_traffic, None, 0
                     )
+                    continue
 
-            bonus_result = {}
+                self.__evaluate(uuid, username, user_traffic, *progress)
+            return
 
-            async with self.__session_maker() as session:
-                async with session.begin():
-                    for user_id, column, value in users_to_update:
-                        # Этот запрос можно оптимизировать через .where(UserTrafficProgress.user_id._in())
-                        await session.execute(
-                            update(UserTrafficProgress)
-                            .where(UserTrafficProgress.user_id == user_id)
-                            .values({column: value})
-                        )
+        # сравнение со снапшотом - векторный поиск, в Python доходят только новые
+        # пользователи, пользователи с изменившимся трафиком и отложенные (KRETRY_TRAFFIC)
+        found, known_traffic, user_ids, flags = self.__snapshot.lookup(uuids)
+        changed = np.flatnonzero(~found | (known_traffic != traffic))
 
-                    if referrer_bonuses:
-                        bonus_result = await self.__add_bonuses_if_needed(
-                            session, rwms_client, referrer_bonuses
-                        )
+        for i, uuid, username in zip(
+            changed.tolist(), decode_uuids(uuids[changed]), usernames[changed].tolist()
+        ):
+            user_traffic = float(traffic[i])
 
-            self.__log.info(
-                f"updated traffic progress for {len(users_to_update)} users"
+            if not found[i] or user_ids[i] == KNO_USER_ID:
+                self.__pending_lookups.append((uuid, username, user_traffic))
+                continue
+
+            self.__evaluate(
+                uuid, username, user_traffic, int(user_ids[i]), int(flags[i])
+            )
+
+    def __evaluate(
+        self, uuid: str, username: str, traffic: float, user_id: int, flags: int
+    ) -> None:
+        new_flags = flags
+
+        if traffic > 0 and not flags & KPASSED_0:
+            new_flags |= KPASSED_0
+            self.__users_to_update.append((user_id, "passed_0", True))
+            self.__conversions_to_send.append((username, ConversionEvent.HAS_TRAFFIC))
+
+        if traffic > K5MB and not flags & KPASSED_5MB:
+            new_flags |= KPASSED_5MB
+            self.__users_to_update.append((user_id, "passed_5mb", True))
+            self.__conversions_to_send.append(
+                (username, ConversionEvent.HAS_TRAFFIC_MORE_THAN_5MB)
             )
 
-            return conversions_to_send, bonus_result
+        if traffic > K100MB and not flags & KPASSED_100MB:
+            new_flags |= KPASSED_100MB
+            self.__referrer_bonuses[user_id] = (uuid, username)
+            self.__users_to_update.append((user_id, "passed_100mb", True))
+            self.__conversions_to_send.append(
+                (username, ConversionEvent.HAS_TRAFFIC_MORE_THAN_100MB)
+            )
 
-        except Exception:
-            self.__log.exception(f"error in {self.__class__.__name__}")
+        self.__snapshot_updates[uuid] = TrafficSnapshotEntry(
+            traffic, user_id, new_flags
+        )
+
+    # Новые пользователи и пользователи без строки прогресса: читаем прогресс только для них
+    async def __evaluate_pending_lookups(self) -> None:
+        pending = self.__pending_lookups
+        self.__pending_lookups = []
+
+        usernames = [username for _, username, _ in pending]
+        rows: list[tuple[str, int, int]] = []
+
+        async with self.__session_maker() as session:
+            for start in range(0, len(usernames), KPROGRESS_LOOKUP_BATCH):
+                rows.extend(
+                    await self.__get_users_progress_rows(
+                        session=session,
+                        usernames=usernames[start : start + KPROGRESS_LOOKUP_BATCH],
+                    )
+                )
+
+        user_progress = ProgressTable(rows)
+
+        for uuid, username, traffic in pending:
+            progress = user_progress.get(username)
+
+            if progress is None:
+                self.__snapshot_updates[uuid] = TrafficSnapshotEntry(traffic, None, 0)
+                continue
+
+            self.__evaluate(uuid, username, traffic, *progress)
+
+    async def finish(
+        self,
+        rwms_client: RwmsClient,
+        on_applied: Optional[OnProgressApplied] = None,
+    ) -> tuple[list[tuple[str, ConversionEvent]], dict[int, int]]:
+        if self.__syncing:
+            await self.__update_user_progress()
+
+        lookups_count = len(self.__pending_lookups)
+
+        if self.__pending_lookups:
+            await self.__evaluate_pending_lookups()
+
+        users_to_update = self.__users_to_update
+        conversions_to_send = self.__conversions_to_send
+        referrer_bonuses = self.__referrer_bonuses
+        snapshot_updates = self.__snapshot_updates
+        full_scan = self.__full_scan
+
+        self.__syncing = False
+        self.__user_progress = ProgressTable()
+        self.__users_to_update = []
+        self.__conversions_to_send = []
+        self.__referrer_bonuses = {}
+        self.__snapshot_updates = {}
+
+        # Бонусы начисляются до транзакции прогресса: каждое продление в RWMS
+        # сразу фиксируется своей транзакцией с ReferralBonus, так что откат
+        # прогресса ниже не приводит к повторному продлению в следующем цикле
+        bonus_result, failed_referrals = await self.__add_bonuses_if_needed(
+            rwms_client, list(referrer_bonuses)
+        )
+
+        for tg_id, count in self.__unnotified_bonuses.items():
+            bonus_result[tg_id] = bonus_result.get(tg_id, 0) + count
+
+        self.__unnotified_bonuses = {}
+
+        if failed_referrals:
+            users_to_update, conversions_to_send = self.__postpone_referrals(
+                failed_referrals,
+                referrer_bonuses,
+                users_to_update,
+                conversions_to_send,
+                snapshot_updates,
+            )
 
-    async def __update_user_progress(self, users):
         try:
             async with self.__session_maker() as session:
                 async with session.begin():
-                    for user in users:
-                        traffic = user.lifetime_used_traffic_bytes
-                        passed_0 = traffic > 0
-                        passed_5mb = traffic > K5MB
-                        passed_100mb = traffic > K100MB
-
-                        # SQLAlchemy core approach
-                        insert_stmt = """
-                            INSERT INTO user_traffic_progress (user_id, passed_0, passed_5mb, passed_100mb)
-                            SELECT id, :passed_0, :passed_5mb, :passed_100mb 
-                            FROM users 
-                            WHERE telegram_id = :telegram_id
-                            ON CONFLICT (user_id) DO NOTHING
-                        """
-
-                        self.__log.info(
-                            f"insert user {user.username} to user_traffic_progress"
-                        )
+                    updated_count = await self.__apply_progress_updates(
+                        session, users_to_update
+                    )
 
-                        await session.execute(
-                            text(insert_stmt),
-                            {
-                                "telegram_id": int(user.username),
-                                "passed_0": passed_0,
-                                "passed_5mb": passed_5mb,
-                                "passed_100mb": passed_100mb,
-                            },
-                        )
-        except Exception as e:
-            self.__log.exception(
-                f"Failed to update progress for user {user.username}: {e}"
+                    if on_applied is not None:
+                        await on_applied(session, conversions_to_send, bonus_result)
+        except Exception:
+            # бонусы уже начислены и записаны, уведомления о них уйдут в следующем цикле
+            self.__unnotified_bonuses = bonus_result
+            raise
+
+        # Снапшот меняем только после коммита, иначе при ошибке потеряем конверсии
+        if full_scan:
+            self.__snapshot = TrafficSnapshotTable(snapshot_updates)
+            self.__last_reconciliation = time.monotonic()
+        else:
+            self.__snapshot.update(snapshot_updates)
+            self.__log.info(
+                f"evaluated {len(snapshot_updates)} users with changed traffic "
+                f"({lookups_count} progress lookups), snapshot size {len(self.__snapshot)}"
             )
 
-    async def __get_users_progress(
-        self, session: AsyncSession
-    ) -> dict[str, UserTrafficProgressDto]:
-        result = await session.execute(
-            select(
-                User.username,
-                UserTrafficProgress.user_id,
-                UserTrafficProgress.passed_0,
-                UserTrafficProgress.passed_5mb,
-                UserTrafficProgress.passed_100mb,
-            ).join(User, User.id == UserTrafficProgress.user_id)
+        TRAFFIC_SNAPSHOT_SIZE.set(len(self.__snapshot))
+
+        self.__log.info(f"updated traffic progress for {updated_count} users")
+
+        return conversions_to_send, bonus_result
+
+    # Реферер не получил бонус из-за ошибки RWMS: passed_100mb реферала и его
+    # конверсию не записываем, чтобы следующий цикл оценил его снова и повторил бонус
+    def __postpone_referrals(
+        self,
+        failed_referrals: set[int],
+        referrals: dict[int, tuple[str, str]],
+        users_to_update: list[tuple[int, str, bool]],
+        conversions_to_send: list[tuple[str, ConversionEvent]],
+        snapshot_updates: dict[str, TrafficSnapshotEntry],
+    ) -> tuple[list[tuple[int, str, bool]], list[tuple[str, ConversionEvent]]]:
+        usernames = {referrals[user_id][1] for user_id in failed_referrals}
+
+        for user_id in failed_referrals:
+            uuid = referrals[user_id][0]
+            entry = snapshot_updates[uuid]
+            snapshot_updates[uuid] = TrafficSnapshotEntry(
+                KRETRY_TRAFFIC, entry.user_id, entry.flags & ~KPASSED_100MB
+            )
+
+        self.__log.warning(
+            f"postponed passed_100mb for {len(failed_referrals)} referrals "
+            f"until their referrers' bonuses are applied"
         )
 
-        rows = result.fetchall()
+        return (
+            [
+                (user_id, column, value)
+                for user_id, column, value in users_to_update
+                if not (user_id in failed_referrals and column == "passed_100mb")
+            ],
+            [
+                (username, event)
+                for username, event in conversions_to_send
+                if not (
+                    username in usernames
+                    and event == ConversionEvent.HAS_TRAFFIC_MORE_THAN_100MB
+                )
+            ],
+        )
+
+    # returns a list of tuples of (telegram_id, ConversionEvent)
+    async def find(
+        self,
+        rwms_client: RwmsClient,
+        users: list[proto.UserResponse],
+        on_applied: Optional[OnProgressApplied] = None,
+    ) -> tuple[list[tuple[str, ConversionEvent]], dict[int, int]]:
+        try:
+            await self.begin()
+            await self.scan(users)
+            return await self.finish(rwms_client, on_applied)
+
+        except Exception:
+            self.__log.exception(f"error in {self.__class__.__name__}")
+
+    # Схлопывает (user_id, column, value) по пользователю и применяет одним UPDATE на батч
+    async def __apply_progress_updates(
+        self, session: AsyncSession, users_to_update: list[tuple[int, str, bool]]
+    ) -> int:
+        columns = ("passed_0", "passed_5mb", "passed_100mb")
+        flags_by_user: dict[int, dict[str, bool]] = {}
+
+        for user_id, column, value in users_to_update:
+            flags = flags_by_user.setdefault(user_id, dict.fromkeys(columns, False))
+            flags[column] = flags[column] or value
+
+        user_ids = list(flags_by_user)
+
+        for start in range(0, len(user_ids), KPROGRESS_UPDATE_BATCH):
+            batch = user_ids[start : start + KPROGRESS_UPDATE_BATCH]
+
+            with DB_STATEMENT_DURATION.labels(group="progress_update").time():
+                await session.execute(
+                    BULK_UPDATE_PROGRESS_QUERY,
+                    {
+                        "user_ids": batch,
+                        **{
+                            column: [
+                                flags_by_user[user_id][column] for user_id in batch
+                            ]
+                            for column in columns
+                        },
+                    },
+                )
+
+        return len(user_ids)
+
+    def __collect_sync_rows(self, users: Iterable[proto.UserResponse]) -> None:
+        for user in users:
+            try:
+                telegram_id = int(user.username)
+            except ValueError:
+                self.__log.warning(
+                    f"skip sync for non-numeric username {user.username}"
+                )
+                continue
 
-        return {
-            username: UserTrafficProgressDto(
-                user_id=user_id,
-                passed_0=passed_0,
-                passed_5mb=passed_5mb,
-                passed_100mb=passed_100mb,
+            traffic = user.lifetime_used_traffic_bytes
+            self.__sync_rows.append(
+                (telegram_id, traffic > 0, traffic > K5MB, traffic > K100MB)
             )
+
+    async def __update_user_progress(self) -> None:
+        rows = self.__sync_rows
+        self.__sync_rows = []
+
+        try:
+            await self.__bulk_sync.sync(rows)
+        except Exception as e:
+            self.__log.exception(f"failed to synchronize user progress: {e}")
+
+    # (username, user_id, KPASSED_* флаги)
+    async def __get_users_progress_rows(
+        self, session: AsyncSession, usernames: Optional[list[str]] = None
+    ) -> list[tuple[str, int, int]]:
+        statement = select(
+            User.username,
+            UserTrafficProgress.user_id,
+            UserTrafficProgress.passed_0,
+            UserTrafficProgress.passed_5mb,
+            UserTrafficProgress.passed_100mb,
+        ).join(User, User.id == UserTrafficProgress.user_id)
+
+        if usernames is not None:
+            statement = statement.where(User.username.in_(usernames))
+
+        with DB_STATEMENT_DURATION.labels(group="progress_lookup").time():
+            result = await session.execute(statement)
+
+            rows = result.fetchall()
+
+        return [
+            (username, user_id, progress_flags(passed_0, passed_5mb, passed_100mb))
             for username, user_id, passed_0, passed_5mb, passed_100mb in rows
-        }
+        ]
 
-    # Возвращает словарь, состоящий из количества рефералов достигших 100мб трафика для каждого реферера
+    # Возвращает словарь, состоящий из количества рефералов достигших 100мб трафика для каждого реферера,
+    # и user_id рефералов, чьим реферерам бонус не начислен из-за ошибки RWMS или БД
     async def __add_bonuses_if_needed(
-        self, session: AsyncSession, rwms_client: RwmsClient, user_ids: list[int]
-    ) -> dict[int, int]:
+        self, rwms_client: RwmsClient, user_ids: list[int]
+    ) -> tuple[dict[int, int], set[int]]:
+        bonus_result: dict[int, int] = {}  # telegram_id -> количество рефералов
+        failed_referrals: set[int] = set()  # рефералы, бонус за которых надо повторить
+
+        # 0. Дописываем в БД продления, уже прошедшие в RWMS в прошлых циклах
+        unrecorded = self.__unrecorded_bonuses
+        self.__unrecorded_bonuses = []
+
+        for referrer in unrecorded:
+            if await self.__record_bonus(*referrer):
+                _, referral_ids, _, tg_id = referrer
+                bonus_result[tg_id] = bonus_result.get(tg_id, 0) + len(referral_ids)
+
+        # их рефералы ждут записи, а не нового продления
+        pending_referrals = {
+            referral_id
+            for _, referral_ids, _, _ in self.__unrecorded_bonuses
+            for referral_id in referral_ids
+        }
+        failed_referrals.update(pending_referrals.intersection(user_ids))
+        user_ids = [user_id for user_id in user_ids if user_id not in pending_referrals]
+
+        if not user_ids:
+            return bonus_result, failed_referrals
+
+        async with self.__session_maker() as session:
+            referrers = await self.__find_referrers(session, user_ids)
+
+        # 6. Параллельно получаем подписки рефереров и продлеваем их в RWMS,
+        # каждое успешное продление сразу записываем в БД
+        semaphore = asyncio.Semaphore(self.__bonus_concurrency)
+
+        async def apply_bonus(
+            referrer: tuple[int, list[int], str, int],
+        ) -> Optional[bool]:
+            _, referral_ids, username, _ = referrer
+
+            async with semaphore:
+                referrer_sub = await rwms_client.get_user_by_username(username)
+
+                if not referrer_sub:
+                    self.__log.warning(
+                        f"not found remnawave subscription for {username}"
+                    )
+                    return False
+
+                await update_user(
+                    rwms_client,
+                    [s.uuid for s in referrer_sub.active_internal_squads],
+                    referrer_sub,
+                    timedelta(days=len(referral_ids) * 10),
+                )
+
+            # None - продление в RWMS прошло, но в БД не записано
+            return True if await self.__record_bonus(*referrer) else None
+
+        replies = await asyncio.gather(
+            *(apply_bonus(referrer) for referrer in referrers),
+            return_exceptions=True,
+        )
+
+        # 7. Уведомляем только тех, кому бонус начислен и записан
+        for (_, referral_ids, username, tg_id), reply in zip(referrers, replies):
+            if isinstance(reply, Exception):
+                self.__log.error(f"failed to apply RWMS bonus for {username}: {reply}")
+                failed_referrals.update(referral_ids)
+                continue
+
+            if isinstance(reply, BaseException):
+                raise reply
+
+            if reply is None:
+                failed_referrals.update(referral_ids)
+            elif reply:
+                bonus_result[tg_id] = bonus_result.get(tg_id, 0) + len(referral_ids)
+
+        return bonus_result, failed_referrals
+
+    # (referrer_id, referral_ids, username, telegram_id) для рефералов без TRAFFIC бонуса
+    async def __find_referrers(
+        self, session: AsyncSession, user_ids: list[int]
+    ) -> list[tuple[int, list[int], str, int]]:
         # 1. Получаем рефералов (user_ids) и их рефереров
         referrals_with_referrers = await session.execute(
             select(User.id, User.referred_by_id)
@@ -247,7 +659,7 @@ class UserTrafficProgressWatcher:
         ]  # [(referral_id, referrer_id), ...]
 
         if not referral_data:
-            return {}
+            return []
 
         # 3. Получаем ID рефералов, у которых УЖЕ ЕСТЬ TRAFFIC бонус
         existing_bonuses = await session.execute(
@@ -266,7 +678,7 @@ class UserTrafficProgressWatcher:
         ]
 
         if not new_referrals:
-            return {}
+            return []
 
         # 5. Группируем по реферерам для удобства
         referrals_by_referrer = {}
@@ -286,9 +698,8 @@ class UserTrafficProgressWatcher:
             for user_id, username, telegram_id in result.all()
         }
 
-        bonus_result: dict[int, int] = {}  # telegram_id -> количество рефералов
+        referrers = []
 
-        # 6. Начисляем бонусы
         for referrer_id, referral_ids in referrals_by_referrer.items():
             referrer_info = referrer_data.get(referrer_id)
 
@@ -297,38 +708,45 @@ class UserTrafficProgressWatcher:
                 continue
 
             referrer_username, referrer_tg_id = referrer_info
+            referrers.append(
+                (referrer_id, referral_ids, referrer_username, referrer_tg_id)
+            )
 
-            referrer_sub = await rwms_client.get_user_by_username(referrer_username)
-
-            if not referrer_sub:
-                self.__log.warning(
-                    f"not found remnawave subscription for {referrer_username}"
-                )
-                continue
-
-            # Создаем записи о бонусе для каждого реферала
-            for referral_id in referral_ids:
-                bonus = ReferralBonus(
-                    referral_id=referral_id,
-                    referrer_id=referrer_id,
-                    bonus_type=ReferralBonusType.TRAFFIC,
-                    days_added=10,  # или сколько дней за TRAFFIC
-                )
-                session.add(bonus)
-                bonus_result[referrer_tg_id] = bonus_result.get(referrer_tg_id, 0) + 1
+        return referrers
 
-            total_days = len(referral_ids) * 10
-            bonus_interval = timedelta(days=total_days)
+    # Записывает бонус реферера, уже продленного в RWMS, отдельной транзакцией.
+    # При ошибке запоминает его, чтобы дописать в следующем цикле, и возвращает False
+    async def __record_bonus(
+        self, referrer_id: int, referral_ids: list[int], username: str, tg_id: int
+    ) -> bool:
+        try:
+            async with self.__session_maker() as session:
+                async with session.begin():
+                    # Создаем записи о бонусе для каждого реферала
+                    session.add_all(
+                        ReferralBonus(
+                            referral_id=referral_id,
+                            referrer_id=referrer_id,
+                            bonus_type=ReferralBonusType.TRAFFIC,
+                            days_added=10,  # или сколько дней за TRAFFIC
+                        )
+                        for referral_id in referral_ids
+                    )
 
-            await extend_user_subscription_by_username(
-                session, referrer_username, bonus_interval
+                    with DB_STATEMENT_DURATION.labels(
+                        group="subscription_extend"
+                    ).time():
+                        await extend_users_subscriptions_by_username(
+                            session,
+                            {username: timedelta(days=len(referral_ids) * 10)},
+                        )
+        except Exception as e:
+            self.__log.error(
+                f"failed to record bonus for {username} applied in RWMS: {e}"
             )
-
-            await update_user(
-                rwms_client,
-                [s.uuid for s in referrer_sub.active_internal_squads],
-                referrer_sub,
-                bonus_interval,
+            self.__unrecorded_bonuses.append(
+                (referrer_id, referral_ids, username, tg_id)
             )
+            return False
 
-        return bonus_result
+        return True
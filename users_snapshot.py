@@ -0,0 +1,115 @@
+import calendar
+import numpy as np
+import proto.rwmanager_pb2 as proto
+from datetime import date
+from compact_state import encode_uuids
+from typing import Iterable, NamedTuple
+
+KDAY_SECONDS = 24 * 60 * 60
+
+
+class UsersSnapshot:
+    """
+    Колоночный снимок пользователей RWMS за один цикл: вместо обхода UserResponse
+    с HasField/ToDatetime правила считаются векторными масками по массивам.
+
+    uuid хранятся как ascii bytes (S36). Отсутствующие created_at/expire_at
+    хранятся как -1, нечисловой username дает telegram_id = -1.
+    """
+
+    def __init__(
+        self,
+        uuids: np.ndarray,
+        usernames: np.ndarray,
+        telegram_ids: np.ndarray,
+        traffic: np.ndarray,
+        created_at: np.ndarray,
+        expire_at: np.ndarray,
+    ):
+        self.uuids = uuids
+        self.usernames = usernames
+        self.telegram_ids = telegram_ids
+        self.traffic = traffic
+        self.created_at = created_at
+        self.expire_at = expire_at
+
+    def __len__(self) -> int:
+        return len(self.uuids)
+
+    # telegram id пользователей, созданных в день day (UTC) и без трафика
+    def created_on_without_traffic(self, day: date) -> list[int]:
+        start = calendar.timegm(day.timetuple())
+
+        mask = (
+            (self.created_at >= start)
+            & (self.created_at < start + KDAY_SECONDS)
+            & (self.traffic <= 0)
+            & (self.telegram_ids >= 0)
+        )
+
+        return self.telegram_ids[mask].tolist()
+
+    # бит i выставлен, если трафик больше thresholds[i]
+    def threshold_levels(self, thresholds: list[float]) -> np.ndarray:
+        levels = np.zeros(len(self), dtype=np.uint8)
+
+        for bit, threshold in enumerate(thresholds):
+            levels |= (self.traffic > threshold).astype(np.uint8) << bit
+
+        return levels
+
+
+class UsersColumns(NamedTuple):
+    uuids: np.ndarray
+    usernames: np.ndarray
+    telegram_ids: np.ndarray
+    traffic: np.ndarray
+    created_at: np.ndarray
+    expire_at: np.ndarray
+
+
+# Компактные колонки страницы; это же выполняется в процессах RwmsPagesDecoder
+def users_columns(users: Iterable[proto.UserResponse]) -> UsersColumns:
+    uuids: list[str] = []
+    usernames: list[str] = []
+    telegram_ids: list[int] = []
+    traffic: list[float] = []
+    created_at: list[int] = []
+    expire_at: list[int] = []
+
+    for user in users:
+        username = user.username
+
+        uuids.append(user.uuid)
+        usernames.append(username)
+        telegram_ids.append(int(username) if username.isdigit() else -1)
+        traffic.append(user.lifetime_used_traffic_bytes)
+        created_at.append(
+            user.created_at.seconds if user.HasField("created_at") else -1
+        )
+        expire_at.append(user.expire_at.seconds if user.HasField("expire_at") else -1)
+
+    return UsersColumns(
+        uuids=encode_uuids(uuids),
+        usernames=np.array(usernames, dtype=str),
+        telegram_ids=np.array(telegram_ids, dtype=np.int64),
+        traffic=np.array(traffic, dtype=np.float64),
+        created_at=np.array(created_at, dtype=np.int64),
+        expire_at=np.array(expire_at, dtype=np.int64),
+    )
+
+
+class UsersSnapshotBuilder:
+    def __init__(self):
+        self.__chunks: list[UsersColumns] = []
+
+    def add_page(self, users: Iterable[proto.UserResponse]) -> None:
+        self.__chunks.append(users_columns(users))
+
+    def add_columns(self, columns: UsersColumns) -> None:
+        self.__chunks.append(columns)
+
+    def build(self) -> UsersSnapshot:
+        chunks = self.__chunks or [users_columns([])]
+
+        return UsersSnapshot(*(np.concatenate(column) for column in zip(*chunks)))